@@ -10,7 +10,7 @@ from .utils import debug
 
 from .containers import ListContainer, DictContainer
 
-from .base import Element, Block, Inline, MetaValue
+from .base import Element, Block, Inline, MetaValue, Deferred, defer
 
 # These elements are not part of pandoc-types
 from .elements import (
@@ -31,12 +31,37 @@ from .table_elements import (
 from .elements import (
     MetaList, MetaMap, MetaString, MetaBool, MetaInlines, MetaBlocks)
 
-from .io import load, dump, run_filter, run_filters
+from .io import load, dump, run_filter, run_filters, applies_to, uses_global_state
 from .io import toJSONFilter, toJSONFilters  # Wrappers
 
 from .tools import (
-    stringify, yaml_filter, shell, run_pandoc, convert_text, get_option)
-
-from .autofilter import main, panfl, get_filter_dirs, stdio
+    stringify, yaml_filter, shell, run_pandoc, convert_text, convert_text_many,
+    get_option)
 
 from .version import __version__
+
+
+# The command line interface (and click) is loaded on first use
+_lazy_attributes = {
+    'main': 'autofilter',
+    'panfl': 'autofilter',
+    'get_filter_dirs': 'autofilter',
+    'stdio': 'autofilter',
+}
+
+# Left out of "from panflute import *", which would otherwise load them
+__all__ = [name for name in globals() if not name.startswith('_')]
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        from importlib import import_module
+        module = import_module('.' + _lazy_attributes[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attributes))
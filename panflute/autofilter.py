@@ -10,11 +10,21 @@ import os
 import os.path as p
 from pathlib import Path
 import sys
+import json
 import click
 from io import StringIO
 
 from .io import load, dump
-from .utils import debug, ContextImport
+from .utils import debug, ContextImport, load_json_cache, save_json_cache
+
+
+# Cache of where each filter was found (see resolve_filters)
+FILTER_CACHE_FILE = 'filters.json'
+FILTER_CACHE_SIZE = 256
+
+# File (and its mtime) that each filter module was imported from
+# (see forget_stale_filter)
+_imported_filters = {}
 
 
 reduced_sys_path = [d for d in sys.path if (d not in ('', '.')) and p.isdir(d)]
@@ -52,7 +62,7 @@ def get_filter_dirs(hardcoded=True):
 
 
 def stdio(filters=None, search_dirs=None, data_dir=True, sys_path=True,
-          panfl_=False, input_stream=None, output_stream=None):
+          panfl_=False, input_stream=None, output_stream=None, verbose=False):
     """
     Reads JSON from stdin and second CLI argument:
     ``sys.argv[1]``. Dumps JSON doc to the stdout.
@@ -68,11 +78,14 @@ def stdio(filters=None, search_dirs=None, data_dir=True, sys_path=True,
         for debug purpose
     :param output_stream: io.StringIO or None
         for debug purpose
+    :param verbose: bool
+        display debugging info (as with the metadata ``panflute-verbose``),
+        including whether filter locations came from the cache
     :return: None
     """
 
     doc = load(input_stream)
-    verbose = doc.get_metadata('panflute-verbose', False)
+    verbose = verbose or doc.get_metadata('panflute-verbose', False)
 
     if search_dirs is None:
         # metadata 'panflute-path' can be a list, a string, or missing
@@ -89,22 +102,7 @@ def stdio(filters=None, search_dirs=None, data_dir=True, sys_path=True,
 
     if verbose:
         debug('panflute: data_dir={} sys_path={}'.format(data_dir, sys_path))
-    search_dirs = [p.normpath(p.expanduser(p.expandvars(d)))
-                   for d in search_dirs]
-
-    if not panfl_:
-        # default panflute behaviour:
-        search_dirs.append('.')
-        if data_dir:
-            search_dirs.extend(get_filter_dirs())
-        if sys_path:
-            search_dirs += sys.path
-    else:
-        # panfl/pandoctools behaviour:
-        if data_dir:
-            search_dirs.extend(get_filter_dirs())
-        if sys_path:
-            search_dirs += reduced_sys_path
+    search_dirs = expand_search_dirs(search_dirs, data_dir, sys_path, panfl_)
 
     if verbose:
         debug('panflute will search for filters in the following folders:')
@@ -130,9 +128,45 @@ def stdio(filters=None, search_dirs=None, data_dir=True, sys_path=True,
     elif verbose:
         debug("panflute: no filters were provided")
 
+    if verbose:
+        from .cache import convert_cache
+        if convert_cache.is_enabled():
+            debug('panflute: convert_text cache:', convert_cache.stats())
+
     dump(doc, output_stream)
 
 
+def expand_search_dirs(search_dirs, data_dir=True, sys_path=True, panfl_=False):
+    """
+    Normalize the directories where filters are searched, and append
+    the default ones (current folder, Pandoc data dir, ``sys.path``).
+
+    :param search_dirs: list of str
+    :param data_dir: bool
+    :param sys_path: bool
+    :param panfl_: bool
+    :return: list of str
+    """
+    search_dirs = [p.normpath(p.expanduser(p.expandvars(d)))
+                   for d in search_dirs]
+
+    if not panfl_:
+        # default panflute behaviour:
+        search_dirs.append('.')
+        if data_dir:
+            search_dirs.extend(get_filter_dirs())
+        if sys_path:
+            search_dirs += sys.path
+    else:
+        # panfl/pandoctools behaviour:
+        if data_dir:
+            search_dirs.extend(get_filter_dirs())
+        if sys_path:
+            search_dirs += reduced_sys_path
+
+    return search_dirs
+
+
 def main():
     """
     Allows Panflute to be run as a command line executable
@@ -160,6 +194,10 @@ importing the filter!
 
 Search preserves directories order (except for --data-dir and
 `sys.path`).
+
+With --serve, Panflute keeps running in the background with the FILTERS
+already imported, so `pandoc --filter panfl-client` can skip the startup
+cost (Unix only).
 """
 
 
@@ -175,7 +213,17 @@ Search preserves directories order (except for --data-dir and
 @click.option('--no-sys-path', 'sys_path', is_flag=True, default=True,
               help="Disable search filters in python's `sys.path` (without '' and '.') " +
                    "that is appended to the search list.")
-def panfl(filters, to, search_dirs, data_dir, sys_path):
+@click.option('--serve', is_flag=True, default=False,
+              help="Run as a persistent server that keeps panflute and FILTERS imported; " +
+                   "then use `pandoc --filter panfl-client`.")
+@click.option('--socket', 'socket_path', type=str, default=None,
+              help="Unix socket used by --serve (default: $PANFLUTE_SOCKET or " +
+                   "$XDG_RUNTIME_DIR/panflute-<uid>/panflute.sock); " +
+                   "its folder must be private (mode 0700).")
+@click.option('--verbose', '-v', is_flag=True, default=False,
+              help="Display debugging info, such as where filters were found " +
+                   "(and if that came from the cache).")
+def panfl(filters, to, search_dirs, data_dir, sys_path, serve, socket_path, verbose):
     """
     Allows Panflute to be run as a command line executable:
 
@@ -190,7 +238,15 @@ def panfl(filters, to, search_dirs, data_dir, sys_path):
     MIND THAT Panflute temporarily prepends folder of the filter
     (or relevant dir provided if module spec) TO THE `sys.path` before
     importing the filter!
+
+    * to be used as a persistent filter server (``panfl --serve foo.bar``),
+      so Pandoc can call the faster ``panfl-client`` shim instead
     """
+    if serve:
+        from .server import serve as serve_filters
+        serve_filters(socket_path, filters, search_dirs, data_dir, sys_path)
+        return
+
     if to is None:
         if (len(filters) > 1) or search_dirs or not sys_path or data_dir:
             raise ValueError('When no `--to` option then Pandoc filter mode assumed and ' +
@@ -204,63 +260,206 @@ def panfl(filters, to, search_dirs, data_dir, sys_path):
         sys.argv[1:] = []
         sys.argv.append(to)
 
-    stdio(filters, search_dirs, data_dir, sys_path, panfl_=True)
+    stdio(filters, search_dirs, data_dir, sys_path, panfl_=True, verbose=verbose)
 
 
-def autorun_filters(filters, doc, search_dirs, verbose):
+def resolve_filters(filters, search_dirs, verbose=False):
     """
+    Find where each filter lives.
+
+    Results are kept in an on-disk cache (see :func:`.get_cache_dir`) keyed
+    by the filter name and the search directories. A cached location is
+    reused while the file found before is unchanged, and while none of the
+    folders searched before it has changed (their modification times are
+    cached as well), as adding or removing a file there could shadow it.
+
     :param filters: list of str
-    :param doc: panflute.Doc
     :param search_dirs: list of str
     :param verbose: bool
-    :return: panflute.Doc
+    :return: list of (filter, filter_path, module, extra_dir) tuples,
+        as used by :class:`.ContextImport`
     """
-    def remove_py(s):
-        return s[:-3] if s.endswith('.py') else s
+    cache = load_json_cache(FILTER_CACHE_FILE)
+    abs_dirs = [p.abspath(path) for path in search_dirs]
+    modified = False
 
     filter_paths = []
     for filter_ in filters:
-        filter_exp = p.normpath(p.expanduser(p.expandvars(filter_)))
+        key = json.dumps([filter_, abs_dirs])
+        cached = cache.get(key)
+        if cached is not None and is_cached_filter_fresh(cached):
+            if verbose:
+                debug(f'panflute: filter "{filter_}" found in {cached[1]} (cached)')
+            filter_paths.append(tuple(cached[:4]))
+            continue
+
+        found = find_filter(filter_, search_dirs, verbose)
+        filter_paths.append(found)
+        cache.pop(key, None)  # Move to the end, so it's evicted last
+        cache[key] = list(found) + [get_mtime(found[1]),
+                                    get_searched_folders(filter_, found[1], search_dirs)]
+        modified = True
+
+    if modified:
+        while len(cache) > FILTER_CACHE_SIZE:
+            del cache[next(iter(cache))]
+        save_json_cache(FILTER_CACHE_FILE, cache)
+
+    return filter_paths
+
+
+def find_filter(filter_, search_dirs, verbose=False):
+    """
+    Look for a filter in each of the search directories
 
-        if filter_exp == remove_py(p.basename(filter_exp)).lstrip('.'):
-            # import .foo  # is not supported
-            module = True
-            mod_path = filter_exp.replace('.', p.sep)
-            path_postfixes = (p.join(mod_path, '__init__.py'), mod_path + '.py')
-        else:
-            module = False
-            # allow with and without .py ending
-            path_postfixes = (remove_py(filter_exp) + '.py',)
+    :param filter_: str
+    :param search_dirs: list of str
+    :param verbose: bool
+    :return: (filter, filter_path, module, extra_dir) tuple
+    """
+    filter_exp, module, path_postfixes = parse_filter(filter_)
+
+    for path, path_postf, filter_path in iter_candidates(path_postfixes, search_dirs):
+        if p.isfile(filter_path):
+            if verbose:
+                debug(f'panflute: filter "{filter_}" found in {filter_path}')
+
+            if module and not (path in reduced_sys_path):
+                extra_dir = p.abspath(path)
+                # `path` already doesn't contain `.`, `..`, env vars or `~`
+            else:
+                extra_dir = None
+            module_ = filter_exp if module else filter_path
+
+            return filter_, filter_path, module_, extra_dir
+        elif p.isabs(path_postf):
+            if verbose:
+                debug(f'          filter "{filter_}" NOT found in {filter_path}')
+            raise Exception("filter not found: " + filter_)
+        elif verbose:
+            debug(f'          filter "{filter_}" NOT found in {filter_path}')
+
+    raise Exception("filter not found: " + filter_)
 
-        for path, path_postf in [(path, path_postf)
-                                 for path in search_dirs
-                                 for path_postf in path_postfixes]:
+
+def parse_filter(filter_):
+    """
+    Expand a filter name, and list the files (relative to a search
+    directory) where the filter could be
+
+    :param filter_: str
+    :return: (filter_exp, module, path_postfixes) tuple
+    """
+    def remove_py(s):
+        return s[:-3] if s.endswith('.py') else s
+
+    filter_exp = p.normpath(p.expanduser(p.expandvars(filter_)))
+
+    if filter_exp == remove_py(p.basename(filter_exp)).lstrip('.'):
+        # import .foo  # is not supported
+        module = True
+        mod_path = filter_exp.replace('.', p.sep)
+        path_postfixes = (p.join(mod_path, '__init__.py'), mod_path + '.py')
+    else:
+        module = False
+        # allow with and without .py ending
+        path_postfixes = (remove_py(filter_exp) + '.py',)
+
+    return filter_exp, module, path_postfixes
+
+
+def iter_candidates(path_postfixes, search_dirs):
+    """
+    Yield (search_dir, path_postfix, filter_path) for every file that
+    could be the filter, in search order
+    """
+    for path in search_dirs:
+        for path_postf in path_postfixes:
             if p.isabs(path_postf):
                 filter_path = path_postf
             else:
                 filter_path = p.abspath(p.normpath(p.join(path, path_postf)))
+            yield path, path_postf, filter_path
 
-            if p.isfile(filter_path):
-                if verbose:
-                    debug(f'panflute: filter "{filter_}" found in {filter_path}')
-
-                if module and not (path in reduced_sys_path):
-                    extra_dir = p.abspath(path)
-                    # `path` already doesn't contain `.`, `..`, env vars or `~`
-                else:
-                    extra_dir = None
-                module_ = filter_exp if module else filter_path
-
-                filter_paths.append((filter_, filter_path, module_, extra_dir))
-                break
-            elif p.isabs(path_postf):
-                if verbose:
-                    debug(f'          filter "{filter_}" NOT found in {filter_path}')
-                raise Exception("filter not found: " + filter_)
-            elif verbose:
-                debug(f'          filter "{filter_}" NOT found in {filter_path}')
-        else:
-            raise Exception("filter not found: " + filter_)
+
+def get_searched_folders(filter_, filter_path, search_dirs):
+    """
+    List the folders searched before finding a filter in ``filter_path``,
+    with their modification times (None if missing); a filter added to
+    any of them would shadow the one found
+
+    :return: list of [folder, mtime] pairs
+    """
+    _, _, path_postfixes = parse_filter(filter_)
+    folders = {}
+    for _, _, candidate in iter_candidates(path_postfixes, search_dirs):
+        if candidate == filter_path:
+            break
+        folder = p.dirname(candidate)
+        if folder not in folders:
+            folders[folder] = get_mtime(folder)
+    return [list(item) for item in folders.items()]
+
+
+def is_cached_filter_fresh(cached):
+    """
+    Check that a cached filter location can still be used: the filter is
+    unchanged, and so are the folders searched before it
+    """
+    if len(cached) != 6 or get_mtime(cached[1]) != cached[4]:
+        return False
+    return all(get_mtime(folder) == mtime for folder, mtime in cached[5])
+
+
+def get_mtime(path):
+    """
+    Return the modification time of a file or folder (in ns), or None if it's missing
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def forget_stale_filter(module_, filter_path, extra_dir=None):
+    """
+    Remove a filter module from ``sys.modules`` if it was imported from
+    another file, or if its file changed since, so the next import loads
+    ``filter_path``.
+
+    Long-lived processes need this, as two filters can have the same
+    module name: filters preloaded by ``panfl --serve`` stay imported
+    in the children that handle each document, while the document might
+    be in a project with its own ``filters/include.py``.
+
+    :param module_: str
+    :param filter_path: str
+    :param extra_dir: str or None
+    """
+    name = ContextImport(module_, extra_dir).module
+    current = (p.realpath(filter_path), get_mtime(filter_path))
+    module = sys.modules.get(name)
+    if module is not None:
+        loaded = _imported_filters.get(name)
+        if loaded is None:  # Imported by other means
+            loaded = (p.realpath(getattr(module, '__file__', None) or ''), current[1])
+        if loaded != current:
+            # Also the parent packages of "dir.fi", as they might be elsewhere
+            parts = name.split('.')
+            for i in range(1, len(parts) + 1):
+                sys.modules.pop('.'.join(parts[:i]), None)
+    _imported_filters[name] = current
+
+
+def autorun_filters(filters, doc, search_dirs, verbose):
+    """
+    :param filters: list of str
+    :param doc: panflute.Doc
+    :param search_dirs: list of str
+    :param verbose: bool
+    :return: panflute.Doc
+    """
+    filter_paths = resolve_filters(filters, search_dirs, verbose)
 
     # Intercept any print() statements made by filters (which would cause Pandoc to fail)
     sys.stdout = alt_stdout = StringIO()
@@ -268,6 +467,7 @@ def autorun_filters(filters, doc, search_dirs, verbose):
     for filter_, filter_path, module_, extra_dir in filter_paths:
         if verbose:
             debug("panflute: running filter <{}>".format(filter_))
+        forget_stale_filter(module_, filter_path, extra_dir)
         with ContextImport(module_, extra_dir) as module:
             try:
                 module.main(doc)
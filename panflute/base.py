@@ -10,11 +10,13 @@ from __future__ import annotations
 from panflute.containers import DictContainer, ListContainer
 from typing import Any
 
+import os
+import threading
 from operator import attrgetter
 from collections.abc import MutableSequence, MutableMapping, Callable
 
-from .containers import ListContainer, DictContainer
-from .utils import check_type, encode_dict  # check_group
+from .containers import ListContainer, DictContainer, SHARED, invalidate_digest
+from .utils import check_type, encode_dict, trusted_construction  # check_group
 
 # ---------------------------
 # Meta Classes
@@ -25,7 +27,7 @@ class Element(object):
     """
     Base class of all Pandoc elements
     """
-    __slots__ = ['parent', 'location', 'index']
+    __slots__ = ['parent', 'location', '_index', '_digest']
     _children = []
 
     def __new__(cls, *args, **kwargs) -> Element:
@@ -33,7 +35,8 @@ class Element(object):
         element = object.__new__(cls)
         element.parent = None
         element.location = None
-        element.index = None
+        element._index = None
+        element._digest = None
         return element
 
     @property
@@ -43,6 +46,8 @@ class Element(object):
 
     def __eq__(self, other):
         # Doc has a different method b/c it uses __dict__ instead of slots
+        if self is other:
+            return True
         if type(self) != type(other):
             return False
 
@@ -52,6 +57,9 @@ class Element(object):
 
         return True
 
+    def __hash__(self):
+        return hash(self._get_digest())
+
 
     # ---------------------------
     # Base methods
@@ -90,6 +98,71 @@ class Element(object):
         # Default when the element contains nothing
         return []
 
+    # ---------------------------
+    # Digests
+    # ---------------------------
+
+    def digest(self) -> str:
+        """
+        Return a hash of the element and all its children, such as
+        ``'5b1e0c38f2d0ae5a4f0e6b3d1a6b8c2e'``; equal elements have
+        equal digests, regardless of their parents.
+
+        Digests are cached on every element of the tree, so computing it
+        again after changing part of the tree only hashes the elements that
+        changed and their ancestors. This makes them useful as cache keys
+        (``doc.digest()``), to find duplicated elements (elements can be
+        used as dict keys), and to compare large documents repeatedly
+        (``a.digest() == b.digest()``). ``==`` itself always compares the
+        elements, so it doesn't depend on the cached digests.
+
+        The cached digests are discarded when the tree is changed through
+        its containers (e.g. ``elem.content.append(...)``), by assigning
+        them (e.g. ``elem.content = ...``), or by the actions of
+        :meth:`walk`. Other in-place changes, such as ``elem.text = 'x'``
+        or ``elem.classes.append('x')`` outside of a walk, must be followed
+        by :meth:`reset_digest`.
+
+        :rtype: :class:`str`
+        """
+        return self._get_digest().hex()
+
+    def reset_digest(self):
+        """
+        Discard the cached digests of the element and its ancestors,
+        after changing its attributes in place (see :meth:`digest`)
+        """
+        invalidate_digest(self)
+
+    def _get_digest(self):
+        if self._digest is None:
+            _compute_digests(self)
+        return self._digest
+
+    # ---------------------------
+    # Copying
+    # ---------------------------
+
+    def clone(self) -> Element:
+        """
+        Return a copy of the element and all its children, such as a
+        header to be repeated in a table of contents.
+
+        This is much faster than :func:`copy.deepcopy`: the tree is copied
+        in a single pass, without validating the elements again (they were
+        validated when the original was built) and without copying the
+        parents of the element. So the copy is not part of any document
+        until it is inserted into one (``.parent`` is ``None``), but its
+        children point to their new parents.
+
+        Attributes that are lists or dicts (such as ``.classes`` and
+        ``.attributes``) are copied, so they can be changed without
+        affecting the original.
+
+        :rtype: :class:`Element`
+        """
+        return _clone_tree(self)
+
     # ---------------------------
     # .identifier .classes .attributes
     # ---------------------------
@@ -122,6 +195,7 @@ class Element(object):
 
     @content.setter
     def content(self, value):
+        invalidate_digest(self)
         oktypes: type | tuple[type] = self._content.oktypes
         value = value.list if isinstance(value, ListContainer) else list(value)
         self._content: ListContainer = ListContainer(*value, oktypes=oktypes, parent=self)
@@ -138,6 +212,33 @@ class Element(object):
     # Navigation
     # ---------------------------
 
+    @property
+    def index(self) -> int | None:
+        """
+        Position of the element within its ``ListContainer``
+        (or None if it is not in a list)
+
+        Indexes are kept up to date when elements are inserted or deleted
+        before this one: the container renumbers its elements the first
+        time one of the indexes that moved is read.
+
+        :rtype: ``int`` | ``None``
+        """
+        index = self._index
+        if index is not None:
+            container = self.container
+            stale = getattr(container, 'stale', None)
+            if stale is not None and index >= stale:
+                items = container.list
+                if index >= len(items) or items[index] is not self:
+                    container._renumber()
+                    index = self._index
+        return index
+
+    @index.setter
+    def index(self, value):
+        self._index = value
+
     @property
     def container(self) -> ListContainer | DictContainer | None:
         """
@@ -227,6 +328,13 @@ class Element(object):
         Walk through the element and all its children (sub-elements),
         applying the provided function ``action``.
 
+        The walk is post-order (children are visited before their parent),
+        and it uses an explicit stack instead of recursion, so deeply
+        nested documents don't hit Python's recursion limit.
+        Containers such as ``.content`` are modified in place, and only
+        rebuilt if an action replaced or deleted some of their elements;
+        so walks that only read the document are cheap.
+
         A trivial example would be:
 
         .. code-block:: python
@@ -240,8 +348,28 @@ class Element(object):
             altered = doc.walk(no_action)
 
 
-        :param action: function that takes (element, doc) as arguments.
-        :type action: :class:`function`
+        Actions that wait on external programs can return a placeholder
+        through :func:`defer`, so the programs run concurrently; the
+        placeholders are replaced before ``walk`` returns.
+
+        Instead of a single function, ``action`` can also be a dict that maps
+        element classes to functions, such as
+        ``{CodeBlock: highlight, Header: number_header}``.
+        In that case, each function is only called on elements of its class
+        (or subclasses), and all other elements are skipped without making
+        any Python call (the same applies to functions decorated with
+        :func:`.applies_to`):
+
+        .. code-block:: python
+
+            def highlight(elem, doc):
+                elem.classes.append('highlighted')
+
+            altered = doc.walk({CodeBlock: highlight, Code: highlight})
+
+        :param action: function that takes (element, doc) as arguments,
+            or dict of such functions keyed by element class.
+        :type action: :class:`function` | :class:`dict`
         :param doc: root document; used to access metadata,
             the output format (in ``.format``, other elements, and
             other variables). Only use this variable if for some reason
@@ -256,24 +384,41 @@ class Element(object):
         if doc is None:
             doc = self.doc
 
-        # First iterate over children; unless the stop condition is met
-        if stop_if is None or not stop_if(self):
+        # Dicts of {ElementClass: function} (and actions decorated with
+        # applies_to) dispatch on the type of each element
+        action = HandlerTable.from_action(action)
 
-            # self._children has property *names* so we need a bit of getattr/setattr magic to modify the objects themselves
-            children = ((child_name, getattr(self, child_name)) for child_name in self._children)
+        return walk(self, action, doc, stop_if)
 
-            for child_name, child in children:
-                if isinstance(child, (Element, ListContainer, DictContainer)):
-                    child = child.walk(action, doc, stop_if)
-                elif child is None:
-                    child = None  # Empty table headers or captions
-                else:
-                    raise TypeError(type(child))
-                setattr(self, child_name, child)
+    def iter_descendants(self, types=None, stop_if=None, include_self=False):
+        """
+        Iterate over all the children (sub-elements) of the element,
+        in the same post-order used by :meth:`walk`.
 
-        # Then apply the action() to the root element
-        altered = action(self, doc)
-        return self if altered is None else altered
+        Unlike :meth:`walk`, this only reads the document: elements are
+        yielded lazily, and no container is rebuilt.
+        The ``.parent``, ``.location`` and ``.index`` attributes of the
+        yielded elements are updated, so navigation works as usual.
+
+        Example:
+
+        .. code-block:: python
+
+            from panflute import *
+
+            doc = Doc(Header(Str('Intro')), Para(Link(Str('a'), url='b.html')))
+            urls = [link.url for link in doc.iter_descendants(Link)]
+
+        :param types: only yield elements of these types
+        :type types: ``type`` | ``tuple``, optional
+        :param stop_if: function that takes (element) as argument; if it
+            returns True, the children of the element are skipped.
+        :type stop_if: :class:`function`, optional
+        :param include_self: also yield the element itself (last)
+        :type include_self: :class:`bool`
+        :rtype: generator of :class:`Element`
+        """
+        return iter_elements(self, types, stop_if, include_self)
 
 
 class Inline(Element):
@@ -295,3 +440,608 @@ class MetaValue(Element):
     Base class of all metadata elements
     """
     __slots__ = []
+
+
+# ---------------------------
+# Deferred actions
+# ---------------------------
+
+class Deferred(Block, Inline):
+    """
+    Placeholder returned by :func:`defer`, which takes the place of an
+    element until the walk finishes.
+
+    :param element: the element being replaced
+    :param future: :class:`concurrent.futures.Future` with the result
+    """
+    __slots__ = ['element', 'future']
+    _children = []
+
+    def __init__(self, element, future):
+        self.element = element
+        self.future = future
+
+    def __repr__(self):
+        return 'Deferred({!r})'.format(self.element)
+
+    def result(self):
+        """
+        Wait for the deferred function and return what replaces the
+        placeholder (the original element if the function returned None)
+        """
+        ans = self.future.result()
+        return self.element if ans is None else ans
+
+
+class DeferredState(threading.local):
+    """
+    Placeholders created by :func:`defer` during the innermost walk
+    of the current thread (None outside of walks)
+    """
+    pending = None
+
+
+deferred = DeferredState()
+
+# Bounded pool shared by all deferred functions (created on first use)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def defer(function, element, *args, **kwargs):
+    """
+    Run ``function(element, *args, **kwargs)`` on a background thread,
+    and return a placeholder that an action can return in the meantime.
+
+    This is useful for actions that spend most of their time waiting,
+    such as calling external programs with :func:`.shell`: instead of
+    running them one after another, the walk continues while they run
+    concurrently. Once the walk finishes, every placeholder is replaced
+    by the return value of its function, which is interpreted as the
+    return value of an action (``None`` keeps the element, ``[]``
+    deletes it, etc.).
+
+    The number of threads is ``$PANFLUTE_MAX_THREADS``, or by default
+    the same as in :class:`concurrent.futures.ThreadPoolExecutor`.
+
+    Example:
+
+    .. code-block:: python
+
+        def render(elem, doc):
+            svg = shell(['dot', '-Tsvg'], msg=elem.text.encode('utf-8'))
+            return RawBlock(svg.decode('utf-8'), format='html')
+
+        def action(elem, doc):
+            if isinstance(elem, CodeBlock) and 'graphviz' in elem.classes:
+                return defer(render, elem, doc)
+
+    Notes:
+
+    - Only :class:`Block` and :class:`Inline` elements can be deferred.
+    - The function should not modify the rest of the document, and
+      shouldn't receive an element that contains other placeholders.
+    - With several actions (e.g. in :func:`.run_filters`), later actions
+      see the placeholders, unless they run in a separate walk.
+    - Exceptions raised by the function are raised at the end of the walk.
+
+    :param function: function that returns the replacement of *element*
+    :param element: the element to be replaced
+    :rtype: :class:`Deferred`
+    """
+    pending = deferred.pending
+    if pending is None:
+        raise RuntimeError('defer() can only be used by actions during a walk')
+    placeholder = Deferred(element, _get_executor().submit(function, element, *args, **kwargs))
+    pending.append(placeholder)
+    return placeholder
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                max_workers = os.environ.get('PANFLUTE_MAX_THREADS')
+                _executor = ThreadPoolExecutor(int(max_workers) if max_workers else None,
+                                               thread_name_prefix='panflute')
+    return _executor
+
+
+def _resolve_deferred(placeholders, ans):
+    """
+    Replace the placeholders left by a walk with the results of their
+    functions; ``ans`` is the return value of the walk
+    """
+    # Group the placeholders by container, so each container is rebuilt once
+    containers = {}
+    for placeholder in placeholders:
+        container = None if placeholder.parent is None else placeholder.container
+        if container is not None:
+            containers.setdefault(id(container), (container, set()))[1].add(id(placeholder))
+
+    for container, ids in containers.values():
+        if any(id(item) in ids for item in container.list):
+            items = _splice_deferred(container.list, ids)
+            del container[:]
+            container.extend(items)
+
+    # The walk returned a placeholder, or a list that contains them
+    if isinstance(ans, Deferred):
+        return ans.result()
+    elif type(ans) is list:
+        return _splice_deferred(ans, {id(placeholder) for placeholder in placeholders})
+    return ans
+
+
+def _splice_deferred(items, ids):
+    ans = []
+    for item in items:
+        if id(item) in ids:
+            result = item.result()
+            if type(result) is list:
+                ans.extend(result)
+            else:
+                ans.append(result)
+        else:
+            ans.append(item)
+    return ans
+
+
+# ---------------------------
+# Dispatch
+# ---------------------------
+
+class HandlerTable(dict):
+    """
+    Maps element classes to the function that handles them, as used by
+    :meth:`Element.walk` when it receives a dict of ``{class: function}``.
+
+    Subclasses are resolved through their MRO (so ``{Inline: f}`` handles
+    :class:`.Str`), and the result is cached, so looking up the handler
+    of an element is a single dict access. Classes without a handler map
+    to ``None``.
+
+    :param handlers: dict of ``{class: function}`` pairs
+    :type handlers: ``dict``
+    """
+
+    __slots__ = ['handlers']
+
+    def __init__(self, handlers):
+        super().__init__()
+        self.handlers = dict(handlers)
+
+    def __missing__(self, cls):
+        handler = next((self.handlers[base] for base in cls.__mro__
+                        if base in self.handlers), None)
+        self[cls] = handler
+        return handler
+
+    def __call__(self, elem, doc):
+        handler = self[type(elem)]
+        if handler is not None:
+            return handler(elem, doc)
+
+    @classmethod
+    def from_action(cls, action):
+        """
+        Return the action as a table if it is a dict, or a function
+        decorated with :func:`.applies_to`; otherwise return it unchanged
+        """
+        if not callable(action):
+            return cls(action)
+        types = getattr(action, 'applies_to', None)
+        if types is not None:
+            return cls({type_: action for type_ in types})
+        return action
+
+
+# ---------------------------
+# Walk engine
+# ---------------------------
+# Walks are post-order: first the children of an element are walked,
+# then its attributes are updated, and then the action is applied to it.
+# Instead of having Element.walk() and ListContainer.walk() call each other
+# recursively (several Python frames per level), we keep an explicit stack
+# of frames, each a list of [node, kind, position, names_or_keys, results]
+#
+# Containers are only rebuilt if the walk changed them: a list frame keeps
+# results=None until an item gets replaced or deleted, and a container
+# that didn't change is handed back as is, so its parent keeps it.
+
+_ELEMENT, _LIST, _DICT = 0, 1, 2
+
+
+def walk(obj, action, doc, stop_if):
+    """
+    Walk an :class:`Element`, :class:`.ListContainer` or
+    :class:`.DictContainer`, applying ``action`` to every element.
+
+    Returns the same as :meth:`Element.walk` for elements, a list of
+    elements for list containers, and a list of (key, value) pairs for
+    dict containers.
+
+    Placeholders returned through :func:`defer` are replaced at the end.
+    """
+    outer, deferred.pending = deferred.pending, []
+    try:
+        ans = _walk(obj, action, doc, stop_if)
+        if deferred.pending:
+            ans = _resolve_deferred(deferred.pending, ans)
+    finally:
+        deferred.pending = outer
+    return ans
+
+
+def _walk(obj, action, doc, stop_if):
+
+    is_table = type(action) is HandlerTable
+    stack = [_new_frame(obj, stop_if)]
+
+    # Packed runs of text don't need to be unpacked if no action applies to them
+    skip_packed = False
+    if is_table:
+        from .elements import Str, Space, SoftBreak
+        skip_packed = action[Str] is None and action[Space] is None and action[SoftBreak] is None
+
+    while True:
+        frame = stack[-1]
+        node, kind, i, names, out = frame
+
+        if kind is _LIST:
+            items = () if skip_packed and node.packed is not None else node.list
+            child = None
+            while i < len(items):
+                item = items[i]
+                if item.location is SHARED:
+                    # Shared elements get their own copy before an action sees them
+                    if is_table and action[type(item)] is None:
+                        i += 1
+                        if out is not None:
+                            out.append(item)
+                        continue
+                    item = items[i] = type(item)()
+                item.parent = node.parent
+                item.location = node.location
+                item._index = i
+                i += 1
+                if item._children:
+                    child = item
+                    break
+                # Leaf elements (Str, Space, etc.) are handled inline
+                if item._digest is not None:
+                    invalidate_digest(item)  # The action might change it
+                if is_table:
+                    handler = action[type(item)]
+                    altered = None if handler is None else handler(item, doc)
+                else:
+                    altered = action(item, doc)
+                if altered is None or altered is item:
+                    if out is not None:
+                        out.append(item)
+                    continue
+                if out is None:
+                    out = frame[4] = items[:i - 1]
+                if type(altered) is list:
+                    out.extend(altered)
+                else:
+                    out.append(altered)
+
+        elif kind is _DICT:
+            child = None
+            if i < len(names):
+                child = node[names[i]]  # Also attaches parent and location
+                i += 1
+
+        else:
+            child = None
+            while i < len(names):
+                child = getattr(node, names[i])
+                i += 1
+                if isinstance(child, (Element, ListContainer, DictContainer)):
+                    break
+                elif child is None:
+                    setattr(node, names[i - 1], None)  # Empty table headers or captions
+                else:
+                    raise TypeError(type(child))
+
+        if child is not None:
+            frame[2] = i
+            stack.append(_new_frame(child, stop_if))
+            continue
+
+        # All the children of the node have been walked
+        stack.pop()
+        if kind is _ELEMENT:
+            if node._digest is not None:
+                invalidate_digest(node)
+            if is_table:
+                handler = action[type(node)]
+                altered = None if handler is None else handler(node, doc)
+            else:
+                altered = action(node, doc)
+            ans = node if altered is None else altered
+        elif kind is _LIST:
+            ans = node if out is None else out
+        else:
+            unchanged = len(out) == len(node.dict) and all(node.dict.get(k) is v for k, v in out)
+            ans = node if unchanged else out
+
+        if not stack:
+            if ans is node and kind is _LIST:
+                return node.list[:]
+            elif ans is node and kind is _DICT:
+                return out
+            return ans
+
+        # Hand the result back to the parent frame
+        parent = stack[-1]
+        kind = parent[1]
+        if kind is _LIST:
+            out = parent[4]
+            if ans is node:
+                if out is not None:
+                    out.append(ans)
+                continue
+            if out is None:
+                out = parent[4] = parent[0].list[:parent[2] - 1]
+            if type(ans) is list:
+                out.extend(ans)
+            else:
+                out.append(ans)
+        elif kind is _DICT:
+            if ans != []:
+                parent[4].append((parent[3][parent[2] - 1], ans))
+        elif ans is not node:
+            setattr(parent[0], parent[3][parent[2] - 1], ans)
+
+
+def _new_frame(node, stop_if):
+    if isinstance(node, ListContainer):
+        return [node, _LIST, 0, None, None]
+    elif isinstance(node, DictContainer):
+        return [node, _DICT, 0, list(node.dict), []]
+    elif stop_if is None or not stop_if(node):
+        return [node, _ELEMENT, 0, node._children, None]
+    else:
+        return [node, _ELEMENT, 0, (), None]
+
+
+def iter_elements(obj, types=None, stop_if=None, include_self=True):
+    """
+    Iterate over an :class:`Element`, :class:`.ListContainer` or
+    :class:`.DictContainer` and all the elements they contain,
+    in the same post-order as :func:`walk` but without modifying anything.
+    """
+
+    stack = [_new_frame(obj, stop_if)]
+
+    skip_packed = False
+    if types is not None:
+        from .elements import Str, Space, SoftBreak
+        skip_packed = not any(issubclass(cls, types) for cls in (Str, Space, SoftBreak))
+
+    while stack:
+        frame = stack[-1]
+        node, kind, i, names, _ = frame
+        child = None
+
+        if kind is _LIST:
+            items = () if skip_packed and node.packed is not None else node.list
+            while i < len(items):
+                item = items[i]
+                if item.location is SHARED:
+                    if types is not None and not isinstance(item, types):
+                        i += 1
+                        continue
+                    item = items[i] = type(item)()
+                item.parent = node.parent
+                item.location = node.location
+                item._index = i
+                i += 1
+                if item._children:
+                    child = item
+                    break
+                if types is None or isinstance(item, types):
+                    yield item
+
+        elif kind is _DICT:
+            if i < len(names):
+                child = node[names[i]]  # Also attaches parent and location
+                i += 1
+
+        else:
+            while i < len(names):
+                child = getattr(node, names[i])
+                i += 1
+                if isinstance(child, (Element, ListContainer, DictContainer)):
+                    break
+                child = None
+
+        if child is not None:
+            frame[2] = i
+            stack.append(_new_frame(child, stop_if))
+            continue
+
+        stack.pop()
+        if kind is _ELEMENT and (stack or include_self):
+            if types is None or isinstance(node, types):
+                yield node
+
+
+# ---------------------------
+# Digests
+# ---------------------------
+# The digest of an element hashes its tag, its attributes other than its
+# children (e.g. text, identifier, url), and the digests of its children;
+# so when part of a tree changes, only that part and its ancestors are hashed
+# again (see Element.digest and containers.invalidate_digest)
+
+# For every element class, its encoded tag and the slots that hold data
+# instead of children
+_digest_plans = {}
+
+
+def _get_digest_plan(cls):
+    plan = _digest_plans.get(cls)
+    if plan is None:
+        children = set(cls._children) | {'_' + name for name in cls._children}
+        slots = [slot for klass in reversed(cls.__mro__) if klass is not Element
+                 for slot in klass.__dict__.get('__slots__', ())
+                 if slot not in children]
+        plan = _digest_plans[cls] = (cls.__name__.encode('utf-8'), slots)
+    return plan
+
+
+def _compute_digests(root):
+    """
+    Compute the digests of an element and of all its descendants that
+    don't have one, bottom-up (with an explicit stack, like the walk)
+    """
+    import hashlib  # Only needed for digests
+    blake2b = hashlib.blake2b
+
+    stack = [root]
+    while stack:
+        elem = stack[-1]
+        if elem._digest is not None:
+            stack.pop()
+            continue
+
+        # Leaves (Str, Space, etc.) are hashed right away
+        children = [getattr(elem, name) for name in elem._children]
+        pending = False
+        for child in children:
+            if isinstance(child, ListContainer):
+                items = child.list
+            elif isinstance(child, DictContainer):
+                items = child.dict.values()
+            else:
+                items = () if child is None else (child,)
+            for item in items:
+                if isinstance(item, Element) and item._digest is None:
+                    if item._children:
+                        stack.append(item)
+                        pending = True
+                    else:
+                        item._digest = _hash_element(item, (), blake2b)
+        if not pending:
+            stack.pop()
+            elem._digest = _hash_element(elem, children, blake2b)
+
+
+def _hash_element(elem, children, blake2b):
+    tag, slots = _digest_plans.get(type(elem)) or _get_digest_plan(type(elem))
+    h = blake2b(tag, digest_size=16)
+    if slots:
+        # Dicts (e.g. attributes) are equal regardless of their order
+        data = [getattr(elem, slot) for slot in slots]
+        data = [sorted(value.items()) if type(value) is dict else value for value in data]
+        h.update(repr(data).encode('utf-8'))
+    for child in children:
+        if isinstance(child, ListContainer):
+            h.update(b'L%d' % len(child.list))
+            try:
+                h.update(b''.join([item._digest for item in child.list]))
+            except (AttributeError, TypeError):
+                h.update(b''.join([_get_item_digest(item) for item in child.list]))
+        elif isinstance(child, DictContainer):
+            h.update(b'D%d' % len(child.dict))
+            for key in sorted(child.dict):
+                h.update(repr(key).encode('utf-8'))
+                h.update(_get_item_digest(child.dict[key]))
+        elif child is None:
+            h.update(b'N')
+        else:
+            h.update(b'E' + child._digest)
+    return h.digest()
+
+
+def _get_item_digest(item):
+    digest = getattr(item, '_digest', None)
+    if digest is None:
+        return repr(item).encode('utf-8')  # Such as strings in metadata
+    return digest
+
+
+# ---------------------------
+# Clones
+# ---------------------------
+
+# For every element class, all its slots (children and data)
+_clone_slots = {}
+
+
+def _get_clone_slots(cls):
+    slots = _clone_slots.get(cls)
+    if slots is None:
+        slots = _clone_slots[cls] = [
+            slot for klass in cls.__mro__ if klass is not Element
+            for slot in klass.__dict__.get('__slots__', ())]
+    return slots
+
+
+def _clone_tree(root):
+    """
+    Copy an element and its descendants (see Element.clone)
+
+    Copies are created top-down with an explicit stack: each element is
+    created when its parent is copied, and its own attributes are filled
+    in when it is popped from the stack.
+    """
+    stack = []
+
+    def new_element(old, parent, location, index):
+        new = object.__new__(type(old))
+        new.parent = parent
+        new.location = location
+        new._index = index
+        new._digest = None  # Computed on demand, as the copy might be edited
+        stack.append((old, new))
+        return new
+
+    def copy_value(value, parent):
+        if isinstance(value, ListContainer):
+            new = object.__new__(ListContainer)
+            new.oktypes = value.oktypes
+            new.parent = parent
+            new.location = location = value.location
+            new.packed = value.packed
+            new.stale = None
+            if value.packed is None:
+                new.list = [new_element(item, parent, location, i)
+                            if isinstance(item, Element) and item.location is not SHARED else item
+                            for i, item in enumerate(value.list)]
+            return new
+        elif isinstance(value, DictContainer):
+            new = object.__new__(DictContainer)
+            new.oktypes = value.oktypes
+            new.parent = parent
+            new.location = location = value.location
+            new.dict = {key: new_element(item, parent, location, None) if isinstance(item, Element) else item
+                        for key, item in value.dict.items()}
+            return new
+        elif isinstance(value, Element):
+            return new_element(value, parent, value.location, None)
+        elif type(value) is list:
+            return value[:]
+        elif type(value) is dict:
+            return value.copy()
+        return value
+
+    clone = new_element(root, None, None, None)
+    with trusted_construction():  # Pauses the garbage collector
+        while stack:
+            old, new = stack.pop()
+            for slot in _get_clone_slots(type(old)):
+                try:
+                    value = getattr(old, slot)
+                except AttributeError:
+                    continue  # Unset slot
+                setattr(new, slot, copy_value(value, new))
+            if hasattr(old, '__dict__'):  # Doc
+                for key, value in old.__dict__.items():
+                    new.__dict__[key] = copy_value(value, new)
+    return clone
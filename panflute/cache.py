@@ -0,0 +1,246 @@
+"""
+Optional caches for the output of external programs (such as Pandoc)
+
+Results are stored in memory (as an LRU cache) and on disk, as files named
+after the hash of their key (within a subfolder of
+:func:`.get_cache_dir`), so they are reused across builds. Disk caches are
+limited in size: when they grow too large, the least recently used files
+are removed.
+
+The cache of :func:`.convert_text` is disabled unless ``$PANFLUTE_CACHE``
+is set to ``1`` (so it can be enabled for an entire build) or it is
+enabled explicitly; the cache of :func:`.shell` is used by the calls that
+request it with ``cache=True``, and the cache of :func:`.run_filters` by
+calls with ``incremental=True`` (unless disabled with ``enable(False)``,
+or with ``$PANFLUTE_CACHE`` set to ``0``, which turns off every cache):
+
+    >>> from panflute.cache import convert_cache
+    >>> convert_cache.enable()
+    >>> # ...
+    >>> convert_cache.stats()
+    {'memory_hits': 10, 'disk_hits': 2, 'misses': 3}
+"""
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import os.path as p
+import json
+import threading
+from collections import OrderedDict
+
+from .utils import get_cache_dir, cache_disabled, CACHE_ENV_VAR
+
+
+# ---------------------------
+# Classes
+# ---------------------------
+
+class ResultCache:
+    """
+    Two-tier cache of ``bytes`` values, keyed by a hash (see :meth:`key`).
+
+    Safe to use from several threads and processes at the same time:
+    files are written atomically, and a file removed by another process
+    is just a miss.
+
+    :param name: subfolder of the cache folder used by this cache
+    :type name: :class:`str`
+    :param memory_items: maximum number of values kept in memory
+    :type memory_items: :class:`int`
+    :param max_size: maximum size of the values on disk, in bytes
+    :type max_size: :class:`int`
+    """
+
+    def __init__(self, name, memory_items=1024, max_size=256 * 2**20):
+        self.name = name
+        self.memory_items = memory_items
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.enabled = None  # None: check the environment variable
+        self.written = None  # Bytes written since the disk usage was last checked
+        self.reset_stats()
+
+    @property
+    def folder(self):
+        return p.join(get_cache_dir(), self.name)
+
+    def is_enabled(self):
+        if self.enabled is None:
+            return os.environ.get(CACHE_ENV_VAR, '').lower() in ('1', 'true', 'yes', 'on')
+        return self.enabled
+
+    def is_disabled(self):
+        """
+        Return True if the cache was disabled explicitly, or through
+        ``$PANFLUTE_CACHE`` (for caches used on request, such as the one
+        of :func:`.shell`)
+        """
+        if self.enabled is None:
+            return cache_disabled()
+        return not self.enabled
+
+    def enable(self, enabled=True):
+        """
+        Enable (or disable) the cache, regardless of ``$PANFLUTE_CACHE``
+        """
+        self.enabled = enabled
+
+    @staticmethod
+    def key(*parts):
+        """
+        Return the key of a value, as a hash of the JSON-encodable
+        parts it depends on (bytes parts are hashed as they are)
+        """
+        import hashlib  # Only needed when caching
+        h = hashlib.sha256()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = json.dumps(part).encode('utf-8')
+            h.update(len(part).to_bytes(8, 'little'))
+            h.update(part)
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return the value stored under *key*, or None
+        """
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return value
+
+        fn = self._path(key)
+        try:
+            with open(fn, 'rb') as f:
+                value = f.read()
+            os.utime(fn)  # Recently used, so evicted last
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.disk_hits += 1
+            self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        """
+        Store a ``bytes`` value under *key*
+        """
+        with self.lock:
+            self._remember(key, value)
+
+        fn = self._path(key)
+        tmp = '{}.{}.{}.tmp'.format(fn, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(p.dirname(fn), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, fn)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+
+        # Check the size of the cache on the first write,
+        # and then every time we have written a tenth of its maximum size
+        with self.lock:
+            check = self.written is None or self.written > self.max_size // 10
+            self.written = (0 if check else self.written) + len(value)
+        if check:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files, if the disk cache is too large
+        """
+        files = []
+        total = 0
+        for folder in _scandir(self.folder):
+            if not folder.is_dir():
+                continue
+            for entry in _scandir(folder.path):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_size:
+            return
+
+        # Leave some room, so we don't have to evict again right away
+        files.sort()
+        target = self.max_size * 9 // 10
+        for mtime, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """
+        Remove every value, in memory and on disk
+        """
+        with self.lock:
+            self.memory.clear()
+        for folder in _scandir(self.folder):
+            for entry in _scandir(folder.path):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        """
+        Return the number of hits (in memory and on disk) and misses
+        """
+        return {'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses}
+
+    def reset_stats(self):
+        self.memory_hits = self.disk_hits = self.misses = 0
+
+    def _path(self, key):
+        return p.join(self.folder, key[:2], key[2:])
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+
+def _scandir(path):
+    try:
+        return list(os.scandir(path))
+    except OSError:
+        return []
+
+
+# ---------------------------
+# Caches
+# ---------------------------
+
+# Output of Pandoc in convert_text()
+convert_cache = ResultCache('convert', max_size=64 * 2**20)
+
+# Output of external programs in shell(..., cache=True)
+shell_cache = ResultCache('shell', max_size=512 * 2**20)
+
+# Filtered top-level blocks in run_filters(..., incremental=True)
+block_cache = ResultCache('blocks', max_size=256 * 2**20)
@@ -7,9 +7,31 @@ object, and the attribute of the parent object that they correspond to.
 # Imports
 # ---------------------------
 
+import re
 from collections.abc import MutableSequence, MutableMapping
-from itertools import chain
-from .utils import check_type, encode_dict, debug
+from .utils import check_type, encode_dict, debug, construction, trusted_construction
+
+
+# ---------------------------
+# Constants
+# ---------------------------
+
+# Location of the empty elements (such as Space) shared by all containers
+# in compact documents (see load(compact=True)). They are never attached
+# to a container; instead, each container replaces them by their own copy
+# before anyone else can see them, so .parent and .index still work.
+class _Shared:
+    __slots__ = ()
+
+    def __reduce__(self):
+        # Copies and pickles refer to the same marker
+        return 'SHARED'
+
+    def __repr__(self):
+        return 'SHARED'
+
+
+SHARED = _Shared()
 
 
 # ---------------------------
@@ -38,15 +60,70 @@ class ListContainer(MutableSequence[object]):
     # Based on http://stackoverflow.com/a/3488283
     # See also https://docs.python.org/3/library/collections.abc.html
 
-    __slots__ = ['list', 'oktypes', 'parent', 'location']
+    __slots__ = ['list', 'oktypes', 'parent', 'location', 'packed', 'stale']
 
     def __init__(self, *args: MutableSequence[object], oktypes: type | tuple[type]=object, parent: object | None=None):
         self.oktypes: type | tuple[type] = oktypes
         self.parent: object | None = parent
         self.location = None  # Cannot be set through __init__
+        self.packed = None
+        self.stale = None  # Elements with an .index from this value on might have moved
+
+        if construction.trusted:
+            # Items come from a trusted source (e.g. Pandoc), so don't validate them
+            self.list = list(args)
+            for i, item in enumerate(self.list):
+                if item.location is not SHARED:
+                    item.parent = parent
+                    item.location = None
+                    item._index = i
+        else:
+            self.list = []
+            self.extend(args)  # self.oktypes must be set first
+
+    def __getattr__(self, name):
+        # Only called for unset slots, such as .list in packed containers
+        if name == 'list' and self.packed is not None:
+            self.list = _unpack_text(self.packed, self.parent, self.location)
+            self.packed = None
+            return self.list
+        raise AttributeError(name)
+
+    def pack(self):
+        """
+        Store the elements compactly if they are only
+        :class:`.Str`, :class:`.Space` and :class:`.SoftBreak` elements
+        (such as the content of most paragraphs), as a single string.
+        Runs of text that can't be stored that way (such as two
+        :class:`.Str` elements in a row) are left as they are.
+
+        Packed elements take several times less memory. They are recreated
+        (as new objects) the first time they are accessed; but walks with
+        dicts of actions that don't apply to them, :meth:`iter_descendants`
+        for other types, ``==``, :meth:`.Element.clone`, and :func:`.dump`
+        don't need to recreate them.
+
+        :return: whether the elements were packed
+        :rtype: :class:`bool`
+        """
+        if self.packed is None:
+            packed = _pack_text(self.list)
+            if packed is None:
+                return False
+            self.packed = packed
+            del self.list
+        return True
+
+    def __getstate__(self):
+        # Used by copy and pickle; packed text stays packed
+        state = {name: getattr(self, name) for name in ('oktypes', 'parent', 'location', 'packed', 'stale')}
+        if self.packed is None:
+            state['list'] = self.list
+        return state
 
-        self.list = []
-        self.extend(args)  # self.oktypes must be set first
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def __contains__(self, item):
         return item in self.list
@@ -54,9 +131,29 @@ class ListContainer(MutableSequence[object]):
     def __len__(self):
         return len(self.list)
 
+    def __iter__(self):
+        # Same as iterating with __getitem__ (so elements are attached and
+        # shared elements replaced), but without a call for each element
+        items = self.list
+        parent, location = self.parent, self.location
+        for i, item in enumerate(items):
+            if getattr(item, 'location', None) is SHARED:
+                item = items[i] = type(item)()
+            try:
+                item.parent = parent
+                item.location = location
+                item._index = i
+            except AttributeError:
+                pass  # Such as strings
+            yield item
+
     def __getitem__(self, i):
         if isinstance(i, int):
-            return attach(self.list[i], self.parent, self.location, i)
+            if i < 0:
+                i += len(self.list)  # So .index is the position from the start
+                if i < 0:
+                    raise IndexError('list index out of range')
+            return attach(unshare(self.list, i), self.parent, self.location, i)
         else:
             newlist = self.list.__getitem__(i)
             obj = ListContainer(*newlist,
@@ -65,28 +162,66 @@ class ListContainer(MutableSequence[object]):
             return obj
 
     def __delitem__(self, i):
+        invalidate_digest(self.parent)
+        self._invalidate_indexes(_get_start(i, len(self.list)))
         del self.list[i]
 
     def __setitem__(self, i, v):
         if isinstance(i, slice):
-            v = (check_type(x, self.oktypes) for x in v)
+            v = [_own(check_type(x, self.oktypes)) for x in v]
         else:
-            v = check_type(v, self.oktypes)
+            v = _own(check_type(v, self.oktypes))
+        invalidate_digest(self.parent)
+        start = _get_start(i, len(self.list))
         self.list[i] = v
-        attach(self.list[i], self.parent, self.location, i)
+        if isinstance(i, slice):
+            for item in v:
+                attach(item, self.parent, self.location, start)  # Renumbered when read
+            self._invalidate_indexes(start)
+        else:
+            attach(v, self.parent, self.location, start)
 
     def insert(self, i: int, v):
-        v = check_type(v, self.oktypes)
+        v = _own(check_type(v, self.oktypes))
+        invalidate_digest(self.parent)
+        i = min(_get_start(i, len(self.list)), len(self.list))
         self.list.insert(i, v)
-        attach(self.list[i], self.parent, self.location, i)
+        attach(v, self.parent, self.location, i)
+        if i + 1 < len(self.list):
+            self._invalidate_indexes(i)  # The next elements had indexes from i onwards
+
+    def _invalidate_indexes(self, start):
+        # The elements with an index of *start* or more might have moved,
+        # so their .index is updated the next time one of them is read
+        # (see _renumber); this keeps inserting or deleting many elements linear
+        if self.stale is None or start < self.stale:
+            self.stale = start
+
+    def _renumber(self):
+        """
+        Update the .index of the elements that moved since the last time
+        """
+        items = self.list
+        for i in range(self.stale, len(items)):
+            try:
+                items[i]._index = i
+            except AttributeError:
+                pass  # Such as strings
+        self.stale = None
 
     def walk(self, action, doc=None, stop_if=None):
-        ans = (item.walk(action, doc, stop_if) for item in self)
-        # We need to convert single elements to iterables that can be flattened later
-        ans = ((item,) if type(item) is not list else item for item in ans)
-        # Flatten the list, by expanding any sublists
-        ans = list(chain.from_iterable(ans))
-        return ans
+        from .base import walk, HandlerTable
+        action = HandlerTable.from_action(action)
+        # Returns a flat list, where any list returned by action is expanded
+        return walk(self, action, doc, stop_if)
+
+    def iter_descendants(self, types=None, stop_if=None):
+        """
+        Iterate over the elements of the list and all their children,
+        without modifying them (see :meth:`.Element.iter_descendants`)
+        """
+        from .base import iter_elements
+        return iter_elements(self, types, stop_if)
 
     def __str__(self):
         return self.__repr__()
@@ -98,6 +233,8 @@ class ListContainer(MutableSequence[object]):
         # We can't compare on .parent b/c then we would get a circular reference
         if (self.oktypes != other.oktypes) or (self.location != other.location):
             return False
+        if self.packed is not None and other.packed is not None:
+            return self.packed == other.packed
         if len(self.list) != len(other.list):
             return False
         for x, y in zip(self.list, other.list):  # , strict=True
@@ -106,6 +243,8 @@ class ListContainer(MutableSequence[object]):
         return True
 
     def to_json(self):
+        if self.packed is not None:
+            return _packed_to_json(self.packed)
         return [to_json_wrapper(item) for item in self.list]
 
 
@@ -124,14 +263,21 @@ class DictContainer(MutableMapping[str, object]):
 
     __slots__ = ['dict', 'oktypes', 'parent', 'location']
 
-    def __init__(self, *args: MutableMapping[str, object], oktypes: type | tuple[type]=object, parent: Element | None=None, **kwargs):
+    def __init__(self, *args: MutableMapping[str, object], oktypes: type | tuple[type]=object, parent: object | None=None, **kwargs):
         self.oktypes: type | tuple[type] = oktypes
         self.parent: object | None = parent
         self.location = None
 
-        self.dict = dict()
-        self.update(args)  # Must be a sequence of tuples
-        self.update(kwargs)  # Order of kwargs is not preserved
+        if construction.trusted and not kwargs:
+            # Items come from a trusted source (e.g. Pandoc), so don't validate them
+            self.dict = dict(args)
+            for item in self.dict.values():
+                item.parent = parent
+                item.location = None
+        else:
+            self.dict = dict()
+            self.update(args)  # Must be a sequence of tuples
+            self.update(kwargs)  # Order of kwargs is not preserved
 
     def __contains__(self, item):
         return item in self.dict
@@ -143,17 +289,28 @@ class DictContainer(MutableMapping[str, object]):
         return attach(self.dict[k], self.parent, self.location)
 
     def __delitem__(self, k):
+        invalidate_digest(self.parent)
         del self.dict[k]
 
     def __setitem__(self, k, v):
         v = check_type(v, self.oktypes)
+        invalidate_digest(self.parent)
         self.dict[k] = v
         attach(self.dict[k], self.parent, self.location)
 
     def walk(self, action, doc=None, stop_if=None):
-        ans = ((k, v.walk(action, doc, stop_if)) for k, v in self.items())
-        ans = [(k, v) for k, v in ans if v != []]
-        return ans
+        from .base import walk, HandlerTable
+        action = HandlerTable.from_action(action)
+        # Returns a list of (key, value) pairs, without deleted values
+        return walk(self, action, doc, stop_if)
+
+    def iter_descendants(self, types=None, stop_if=None):
+        """
+        Iterate over the values of the dict and all their children,
+        without modifying them (see :meth:`.Element.iter_descendants`)
+        """
+        from .base import iter_elements
+        return iter_elements(self, types, stop_if)
 
     def __str__(self):
         return self.__repr__()
@@ -176,12 +333,116 @@ def attach(element, parent, location, index=None):
     if not isinstance(element, (int, str, bool)):
         element.parent = parent
         element.location = location
-        element.index = index
+        element._index = index
     else:
         debug(f'Warning: element "{type(element)}" has no parent')
     return element
 
 
+def _get_start(i, size):
+    """
+    Return the first position affected by an index or slice
+    """
+    if isinstance(i, slice):
+        positions = range(*i.indices(size))
+        if not positions:
+            return size
+        return positions[-1] if positions.step < 0 else positions[0]
+    return max(i + size, 0) if i < 0 else i
+
+
+def unshare(items, i):
+    """
+    Return ``items[i]``, replacing it by its own copy if it is a shared
+    element (see SHARED)
+    """
+    item = items[i] = _own(items[i])
+    return item
+
+
+def _own(item):
+    # A copy of shared elements, that can be attached to a container
+    if getattr(item, 'location', None) is SHARED:
+        return type(item)()
+    return item
+
+
+def invalidate_digest(element):
+    """
+    Forget the cached digest of an element and of its ancestors
+    (see :meth:`.Element.digest`), as it or its children changed
+    """
+    # Ancestors of an element without a digest don't have one either
+    while element is not None and element._digest is not None:
+        element._digest = None
+        element = element.parent
+
+
+# Packed containers (see ListContainer.pack) join the text of Str elements
+# with ' ' for Space and '\n' for SoftBreak; so they can only hold
+# non-empty Str elements without spaces or newlines, and never two Str
+# elements in a row (as they would be read back as one)
+_packed_tokens = re.compile('([ \n])')
+
+# Str, Space and SoftBreak (imported on first use, as elements imports us)
+_text_classes = None
+
+
+def _get_text_classes():
+    global _text_classes
+    if _text_classes is None:
+        from .elements import Str, Space, SoftBreak
+        _text_classes = Str, Space, SoftBreak
+    return _text_classes
+
+
+def _pack_text(items):
+    Str, Space, SoftBreak = _text_classes or _get_text_classes()
+    parts = []
+    prev = None
+    for item in items:
+        cls = type(item)
+        if cls is Str:
+            text = item.text
+            if not text or ' ' in text or '\n' in text or prev is Str:
+                return None
+            parts.append(text)
+        elif cls is Space:
+            parts.append(' ')
+        elif cls is SoftBreak:
+            parts.append('\n')
+        else:
+            return None
+        prev = cls
+    return ''.join(parts)
+
+
+def _unpack_text(packed, parent, location):
+    Str, Space, SoftBreak = _text_classes or _get_text_classes()
+    items = []
+    with trusted_construction():
+        for token in _packed_tokens.split(packed):
+            if token == ' ':
+                item = Space()
+            elif token == '\n':
+                item = SoftBreak()
+            elif token:
+                item = Str(token)
+            else:
+                continue
+            item.parent = parent
+            item.location = location
+            item._index = len(items)
+            items.append(item)
+    return items
+
+
+def _packed_to_json(packed):
+    return [{'t': 'Space'} if token == ' ' else {'t': 'SoftBreak'} if token == '\n'
+            else {'t': 'Str', 'c': token}
+            for token in _packed_tokens.split(packed) if token]
+
+
 def to_json_wrapper(e):
     if isinstance(e, str):
         return e
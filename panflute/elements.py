@@ -11,7 +11,7 @@ Notation:
 
 from .utils import check_type, check_group, encode_dict, decode_ica, debug, check_type_or_value
 from .utils import load_pandoc_version, load_pandoc_reader_options
-from .containers import ListContainer, DictContainer, MutableSequence, MutableMapping
+from .containers import ListContainer, DictContainer, MutableSequence, MutableMapping, invalidate_digest, SHARED
 from .base import Element, Block, Inline, MetaValue
 from .table_elements import (
     Table, TableHead, TableFoot, TableBody, TableRow, TableCell, Caption,
@@ -77,6 +77,8 @@ class Doc(Element):
             return False
         return True
 
+    __hash__ = Element.__hash__
+
     @property
     def metadata(self):
         self._metadata.parent = self
@@ -85,6 +87,7 @@ class Doc(Element):
 
     @metadata.setter
     def metadata(self, value):
+        invalidate_digest(self)
         value = value.content if isinstance(value, MetaMap) else dict(value)
         self._metadata = MetaMap(*value.items())
 
@@ -494,6 +497,7 @@ class Cite(Inline):
 
     @citations.setter
     def citations(self, value):
+        invalidate_digest(self)
         value = value.list if isinstance(value, ListContainer) else list(value)
         self._citations = ListContainer(*value, oktypes=Citation, parent=self)
         self._citations.location = 'citations'
@@ -541,6 +545,7 @@ class Citation(Element):
 
     @prefix.setter
     def prefix(self, value):
+        invalidate_digest(self)
         value = value.list if isinstance(value, ListContainer) else list(value)
         self._prefix = ListContainer(*value, oktypes=Inline, parent=self)
         self._prefix.location = 'prefix'
@@ -551,6 +556,7 @@ class Citation(Element):
 
     @suffix.setter
     def suffix(self, value):
+        invalidate_digest(self)
         value = value.list if isinstance(value, ListContainer) else list(value)
         self._suffix = ListContainer(*value, oktypes=Inline, parent=self)
         self._suffix.location = 'suffix'
@@ -919,6 +925,7 @@ class DefinitionItem(Element):
 
     @term.setter
     def term(self, value):
+        invalidate_digest(self)
         value = value.list if isinstance(value, ListContainer) else list(value)
         self._term = ListContainer(*value, oktypes=Inline, parent=self)
         self._term.location = 'term'
@@ -929,6 +936,7 @@ class DefinitionItem(Element):
 
     @definitions.setter
     def definitions(self, value):
+        invalidate_digest(self)
         value = value.list if isinstance(value, ListContainer) else list(value)
         self._definitions = ListContainer(*value,
                                           oktypes=Definition, parent=self)
@@ -1047,6 +1055,7 @@ class Figure(Block):
 
     @caption.setter
     def caption(self, value):
+        invalidate_digest(self)
         if value is None:
             value = Caption()
         self._caption = check_type(value, Caption)
@@ -1125,6 +1134,7 @@ class MetaMap(MetaValue, MutableMapping):
 
     @content.setter
     def content(self, value):
+        invalidate_digest(self)
         if isinstance(value, dict):
             value = value.dict.items()
         self._content = DictContainer(*value, oktypes=MetaValue, parent=self)
@@ -1294,6 +1304,16 @@ SPECIAL_ELEMENTS = LIST_NUMBER_STYLES | LIST_NUMBER_DELIMITERS | \
 EMPTY_ELEMENTS = {Null, Space, HorizontalRule, SoftBreak, LineBreak}
 
 
+def _new_shared_element(cls):
+    elem = cls()
+    elem.location = SHARED
+    return elem
+
+
+# A single instance of each empty element, for compact documents
+_shared_elements = {cls.__name__: _new_shared_element(cls) for cls in EMPTY_ELEMENTS}
+
+
 # ---------------------------
 # Functions
 # ---------------------------
@@ -1412,10 +1432,29 @@ _res_func = {
 
 
 def from_json(data):
-    # Metadata key (legacy)
-    if 'unMeta' in data:
-        assert len(data) == 1
-        return MetaMap(*data['unMeta'].items())
+    """
+    Convert a dict decoded from Pandoc's JSON into an element.
+
+    Used as the ``object_hook`` of :func:`json.load`, so it gets called
+    for the deepest dicts first, and their contents have already been
+    converted when it receives a dict.
+    """
+
+    # Standard cases (checked first as they are by far the most common)
+    # Depending on the API we will have
+    # - New API: ('t', 'Space')
+    # - Old API: ('t', 'Space'), ('c', [])
+    tag = data.get('t')
+    if type(tag) is str:
+        # This was slow previously because of the huge if then
+        # use a dict for O(1) lookup
+        builder = _res_func.get(tag)
+        if builder is not None:
+            return builder(data.get('c'))
+        elif tag in SPECIAL_ELEMENTS:
+            return tag
+        else:
+            raise NotImplementedError(f'Unknown tag: {tag}')
 
     # Document (new API)
     if 'pandoc-api-version' in data:
@@ -1425,27 +1464,36 @@ def from_json(data):
         items = data['blocks']
         return Doc(*items, api_version=api, metadata=meta)
 
+    # Metadata key (legacy)
+    if 'unMeta' in data:
+        assert len(data) == 1
+        return MetaMap(*data['unMeta'].items())
+
     # Metadata contents (including empty metadata)
-    if 't' not in data:
-        return data
+    return data
 
-    # Standard cases
 
-    # Depending on the API we will have
-    # - New API: ('t', 'Space')
-    # - Old API: ('t', 'Space'), ('c', [])
-    assert (len(data) == 1) or (len(data) == 2 and 'c' in data)
-    tag = data['t']
-    c = data.get('c')
-
-    # This was slow previously because of the huge if then
-    # use a dict for O(1) lookup
-    if tag in _res_func:
-        return _res_func[tag](c)
-    elif tag in SPECIAL_ELEMENTS:
-        return tag
-    else:
-        raise NotImplementedError(f'Unknown tag: {tag}')
+def _from_json_packed(data):
+    """
+    Same as :func:`from_json`, but packs the text of the elements
+    (see :meth:`.ListContainer.pack`) and shares empty elements
+    """
+    tag = data.get('t')
+    if type(tag) is not str:
+        return from_json(data)
+    shared = _shared_elements.get(tag)
+    if shared is not None:
+        return shared
+    elem = from_json(data)
+    if tag in _PACKABLE_TAGS:
+        elem._content.pack()
+    return elem
+
+
+# Elements whose content can be a run of text
+_PACKABLE_TAGS = {'Plain', 'Para', 'Header', 'Emph', 'Strong', 'Underline',
+                  'Strikeout', 'Superscript', 'Subscript', 'SmallCaps', 'Span',
+                  'Quoted', 'Link', 'Image', 'Cite', 'MetaInlines'}
 
 
 # similar idea to _res_func above
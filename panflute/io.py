@@ -7,7 +7,10 @@ I/O related functions
 # Imports
 # ---------------------------
 
-from .elements import Element, Doc, from_json, ListContainer
+from .elements import Element, Doc, from_json, _from_json_packed, ListContainer
+from .base import HandlerTable
+from .containers import to_json_wrapper, unshare
+from .utils import trusted_construction
 
 # These will get modified if using Pandoc legacy (<1.8)
 from .elements import (Citation, Table, OrderedList, Quoted,
@@ -17,20 +20,33 @@ import io
 import os
 import sys
 import json
-import codecs  # Used in sys.stdout writer
 from functools import partial
 
 
+# ---------------------------
+# Constants
+# ---------------------------
+
+# Encoded output is written to binary streams in chunks of about this size
+WRITE_BUFFER_SIZE = 1 << 20
+
+# With run_filters(processes=N), the document is split into N times this many
+# chunks, so slow chunks don't leave the other processes idle
+PARALLEL_CHUNKS_PER_PROCESS = 4
+
+
 # ---------------------------
 # Functions
 # ---------------------------
 
-def load(input_stream=None):
+def load(input_stream=None, compact=False):
     """
     Load JSON-encoded document and return a :class:`.Doc` element.
 
     The JSON input will be read from :data:`sys.stdin` unless an alternative
-    text stream is given (a file handle).
+    stream is given (a file handle, either in text or binary mode).
+    Standard input is read as raw bytes in a single call, and then decoded
+    together with the JSON.
 
     To load from a file, you can do:
 
@@ -46,16 +62,25 @@ def load(input_stream=None):
         >>> f = io.StringIO(raw)
         >>> doc = pf.load(f)
 
-    :param input_stream: text stream used as input
+    :param input_stream: text or binary stream used as input
         (default is :data:`sys.stdin`)
+    :param compact: store runs of :class:`.Str`, :class:`.Space` and
+        :class:`.SoftBreak` elements compactly, which takes several times
+        less memory for large documents (see :meth:`.ListContainer.pack`)
+    :type compact: :class:`bool`
     :rtype: :class:`.Doc`
     """
 
     if input_stream is None:
-        input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+        input_stream = sys.stdin.buffer
 
-    # Load JSON and validate it
-    doc = json.load(input_stream, object_hook=from_json)
+    # Read everything at once; json.loads() decodes UTF-8 bytes by itself
+    raw = input_stream.read()
+
+    # Load JSON and build the elements; as the JSON comes from Pandoc
+    # we don't need to validate every element
+    with trusted_construction():
+        doc = json.loads(raw, object_hook=_from_json_packed if compact else from_json)
 
     # Notes:
     # - The hook gets called for dicts (not lists), and the deepest dicts
@@ -84,7 +109,9 @@ def dump(doc, output_stream=None):
     Dump a :class:`.Doc` object into a JSON-encoded text string.
 
     The output will be sent to :data:`sys.stdout` unless an alternative
-    text stream is given.
+    stream is given. Binary streams (including :data:`sys.stdout`, which is
+    used through its underlying buffer) receive UTF-8 encoded bytes,
+    written in large chunks.
 
     To dump to :data:`sys.stdout` just do:
 
@@ -106,7 +133,7 @@ def dump(doc, output_stream=None):
 
     :param doc: document, usually created with :func:`.load`
     :type doc: :class:`.Doc`
-    :param output_stream: text stream used as output
+    :param output_stream: text or binary stream used as output
         (default is :data:`sys.stdout`)
     """
 
@@ -114,19 +141,24 @@ def dump(doc, output_stream=None):
         msg = f'panflute.dump needs input of type "panflute.Doc" but received one of type "{type(doc).__name__}"'
         raise TypeError(msg)
 
-    if output_stream is None:
-        sys.stdout = codecs.getwriter("utf-8")(sys.stdout.detach())
-        output_stream = sys.stdout
-
-    json_serializer = lambda elem: elem.to_json()
+    # Write to the buffer below sys.stdout, without replacing sys.stdout
+    # (so we can dump more than once) and without a slow codecs writer
+    to_stdout = output_stream is None
+    if to_stdout:
+        sys.stdout.flush()  # Anything already written goes first
+        output_stream = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    # Write the document in chunks (one per top-level block or metadata field)
+    # instead of building a JSON copy of the entire document in memory
+    chunks = _iter_json_chunks(doc)
+    if isinstance(output_stream, (io.RawIOBase, io.BufferedIOBase)):
+        _write_encoded(chunks, output_stream)
+    else:
+        for chunk in chunks:
+            output_stream.write(chunk)
 
-    output_stream.write(json.dumps(
-        obj=doc,
-        default=json_serializer,  # Serializer
-        check_circular=False,
-        separators=(',', ':'),  # Compact separators, like Pandoc
-        ensure_ascii=False  # For Pandoc compat
-    ))
+    if to_stdout:
+        output_stream.flush()
 
 
 def toJSONFilters(*args, **kwargs):
@@ -148,11 +180,64 @@ def toJSONFilter(*args, **kwargs):
     return run_filter(*args, **kwargs)
 
 
+def applies_to(*types):
+    """
+    Decorator that declares which element types an *action* touches.
+
+    The action will only be called on elements that are instances of the
+    given types, both by :func:`.run_filters` and :meth:`.Element.walk`.
+    With ``fuse=True``, elements that no action applies to are skipped
+    altogether.
+
+    Example:
+
+        >>> import panflute as pf
+        >>> @pf.applies_to(pf.CodeBlock, pf.Code)
+        >>> def upper_code(elem, doc):
+        >>>     elem.text = elem.text.upper()
+
+    :param types: element classes (such as :class:`.CodeBlock`)
+    :type types: :class:`type`
+    """
+
+    def decorator(action):
+        action.applies_to = types
+        return action
+
+    return decorator
+
+
+def uses_global_state(action):
+    """
+    Decorator that marks an *action* as depending on more than the block
+    it is applied to (e.g. numbering figures across the document, or
+    collecting headers for a table of contents).
+
+    Such actions can't reuse the results of previous runs, so
+    ``run_filters(..., incremental=True)`` runs the actions on the whole
+    document if any of them is marked.
+
+    Example:
+
+        >>> import panflute as pf
+        >>> @pf.uses_global_state
+        >>> def number_figures(elem, doc):
+        >>>     if isinstance(elem, pf.Figure):
+        >>>         doc.figure_count += 1
+    """
+    action.uses_global_state = True
+    return action
+
+
 def run_filters(actions,
                 prepare=None, finalize=None,
                 input_stream=None, output_stream=None,
                 doc=None,
                 stop_if=None,
+                fuse=False,
+                processes=None,
+                merge=None,
+                incremental=False,
                 **kwargs):
     r"""
     Receive a Pandoc document from the input stream (default is stdin),
@@ -165,16 +250,49 @@ def run_filters(actions,
       this is done through the :func:`.load` and :func:`.dump` functions.
     - It walks through the document once for every function in *actions*,
       so the actions are applied sequentially.
+    - With ``fuse=True``, it instead walks through the document only once,
+      applying all the *actions* to each element before moving to the next.
+      This gives the same results as long as the actions don't depend on
+      each other's output, and is much faster on large documents.
+      Actions decorated with :func:`.applies_to` are only called on the
+      element types they declare.
     - By default, it will read from stdin and write to stdout,
       but these can be modified.
     - It can also apply functions to the entire document at the beginning and
       end; this allows for global operations on the document.
     - If ``doc`` is a :class:`.Doc` instead of ``None``, ``run_filters``
       will return the document instead of writing it to the output stream.
+    - With ``processes=N``, the top-level blocks of the document are split
+      into chunks, which are filtered in parallel by a pool of N processes
+      and then put back in order. This only works for actions that don't
+      depend on blocks outside of their own chunk (e.g. highlighting code
+      blocks). Each process receives a copy of the document with only its
+      chunk of blocks, and with the attributes added to ``doc`` so far
+      (e.g. by *prepare*), and applies the actions to those blocks only;
+      changes to the attributes of ``doc`` are discarded unless a *merge*
+      function collects them. Once the chunks are put back together (and
+      merged), the actions are applied to the metadata and to ``doc``
+      itself, once, in this process. The actions, *stop_if* and the
+      *kwargs* must be picklable (e.g. functions defined at the top level
+      of the filter), and the filter must only call ``run_filters`` under
+      ``if __name__ == '__main__':``.
+    - With ``incremental=True``, the output of each top-level block is
+      saved in a cache (see :mod:`panflute.cache`), and reused in later
+      runs as long as the block, the metadata, the attributes of ``doc``
+      (e.g. set by *prepare*), the actions and the files that define them
+      are unchanged; so only the blocks that changed since the last run
+      are filtered. The actions are also applied to the metadata and to
+      ``doc`` itself in every run (if applying an action to ``doc`` changes
+      its blocks, the results of that run are not cached). This only works for actions that treat
+      each block on its own; actions that don't (e.g. that number figures)
+      should be decorated with :func:`.uses_global_state`, in which case
+      the whole document is filtered as usual.
 
     :param actions: sequence of functions; each function takes (element, doc)
-     as argument, so a valid header would be ``def action(elem, doc):``
-    :type actions: [:class:`function`]
+     as argument, so a valid header would be ``def action(elem, doc):``.
+     Instead of a function, an action can also be a dict of
+     ``{ElementClass: function}`` pairs (see :meth:`.Element.walk`)
+    :type actions: [:class:`function` | :class:`dict`]
     :param prepare: function executed at the beginning;
      right after the document is received and parsed
     :type prepare: :class:`function`
@@ -189,6 +307,20 @@ def run_filters(actions,
     :type doc: ``None`` | :class:`.Doc`
     :param stop_if: function that takes (element) as argument.
     :type stop_if: :class:`function`, optional
+    :param fuse: apply all the actions in a single walk (default False)
+    :type fuse: :class:`bool`
+    :param processes: number of processes used to filter the top-level
+     blocks in parallel, such as :func:`os.cpu_count`
+     (default is ``None``, which filters the document in this process)
+    :type processes: :class:`int`, optional
+    :param merge: function executed after a parallel run, once for every
+     chunk (in order), receiving (doc, attributes); *attributes* is a dict
+     with the attributes of ``doc`` at the end of that chunk,
+     e.g. ``{'format': 'html', 'figure_count': 3}``
+    :type merge: :class:`function`, optional
+    :param incremental: reuse the results of previous runs for the
+     top-level blocks that have not changed (default False)
+    :type incremental: :class:`bool`
     :param \*kwargs: keyword arguments will be passed through to the *action*
      functions (so they can actually receive more than just two arguments
      (*element* and *doc*)
@@ -202,10 +334,16 @@ def run_filters(actions,
     if prepare is not None:
         prepare(doc)
 
-    for action in actions:
-        if kwargs:
-            action = partial(action, **kwargs)
-        doc = doc.walk(action, doc=doc, stop_if=stop_if)
+    if incremental and processes is not None:
+        raise ValueError('incremental=True cannot be combined with processes')
+
+    if incremental and not any(_uses_global_state(action) for action in actions):
+        doc = _apply_actions_incrementally(doc, actions, stop_if, fuse, kwargs)
+    elif processes is None:
+        doc = _apply_actions(doc, actions, stop_if, fuse, kwargs)
+    else:
+        doc = _apply_actions_in_parallel(doc, actions, stop_if, fuse, kwargs,
+                                         processes, merge)
 
     if finalize is not None:
         finalize(doc)
@@ -225,3 +363,379 @@ def run_filter(action, *args, **kwargs):
     See :func:`.run_filters`
     """
     return run_filters([action], *args, **kwargs)
+
+
+def _apply_actions(doc, actions, stop_if, fuse, kwargs):
+    """
+    Walk through the document with each of the actions (see run_filters)
+    """
+    for action in _prepare_actions(actions, fuse, kwargs):
+        doc = doc.walk(action, doc=doc, stop_if=stop_if)
+    return doc
+
+
+def _prepare_actions(actions, fuse, kwargs):
+    """
+    Return the functions (or handler tables) that each walk will apply
+    """
+    if kwargs:
+        actions = [_partial_action(action, **kwargs) for action in actions]
+
+    if fuse:
+        return [_fuse_actions(actions)]
+    return [HandlerTable.from_action(action) for action in actions]
+
+
+def _apply_actions_incrementally(doc, actions, stop_if, fuse, kwargs):
+    """
+    Apply the actions to the metadata, the top-level blocks that are not
+    in the cache, and the document itself, in the same order as Doc.walk
+    (see run_filters)
+
+    Each changed block is walked on its own, so we know which blocks
+    replaced it; these are then saved as JSON in the cache. If an action
+    applied to the document itself changes its blocks, we can no longer
+    tell which blocks came from which, so the remaining actions are
+    applied to every block of doc.content that was not in the cache,
+    and nothing is saved in the cache.
+    """
+    from .cache import block_cache
+
+    if block_cache.is_disabled():
+        return _apply_actions(doc, actions, stop_if, fuse, kwargs)
+
+    encode = _json_encoder.encode
+    context = _get_incremental_context(doc, actions, stop_if, fuse, kwargs)
+    blocks = doc.content.list
+    keys = [block_cache.key(context, encode(block.to_json())) for block in blocks]
+
+    # For each block, the blocks that replace it
+    results = []
+    changed = []
+    cached = {}  # Blocks that are already filtered, by id
+    with trusted_construction():
+        for i, key in enumerate(keys):
+            value = block_cache.get(key)
+            if value is None:
+                results.append([unshare(blocks, i)])
+                changed.append(i)
+            else:
+                results.append(json.loads(value.decode('utf-8'), object_hook=from_json))
+                cached.update((id(block), block) for block in results[-1])
+
+    # Set the parents and indexes of the blocks, so actions can use them
+    doc.content = [block for result in results for block in result]
+
+    actions = _prepare_actions(actions, fuse, kwargs)
+    for num, action in enumerate(actions, 1):
+        _walk_metadata(action, doc, stop_if)
+
+        content = doc.content.list
+        if results is not None:
+            flat = [block for result in results for block in result]
+            if len(flat) != len(content) or any(a is not b for a, b in zip(flat, content)):
+                results = None  # Changed by an action applied to the document
+
+        if results is not None:
+            for i in changed:
+                results[i] = _walk_blocks(results[i], action, doc, stop_if)
+            doc.content = [block for result in results for block in result]
+        else:
+            new_content = []
+            for block in content:
+                if id(block) in cached:
+                    new_content.append(block)
+                else:
+                    new_content.extend(_walk_blocks([block], action, doc, stop_if))
+            doc.content = new_content
+
+        if num == len(actions) and results is not None:
+            for i in changed:
+                value = '[' + ','.join(encode(block.to_json()) for block in results[i]) + ']'
+                block_cache.set(keys[i], value.encode('utf-8'))
+
+        doc = _call_action(action, doc, doc)
+    return doc
+
+
+def _walk_blocks(blocks, action, doc, stop_if):
+    """
+    Walk through each of the blocks, and return the blocks that replace them
+    """
+    ans = []
+    for block in blocks:
+        altered = block.walk(action, doc=doc, stop_if=stop_if)
+        if altered is None:
+            ans.append(block)
+        elif type(altered) is list:
+            ans.extend(altered)
+        else:
+            ans.append(altered)
+    return ans
+
+
+def _walk_metadata(action, doc, stop_if):
+    """
+    Walk through the metadata of the document (as Doc.walk does before
+    walking its blocks)
+    """
+    metadata = doc.metadata
+    altered = metadata.walk(action, doc=doc, stop_if=stop_if)
+    if altered is not None and altered is not metadata:
+        doc.metadata = altered
+
+
+def _call_action(action, elem, doc):
+    """
+    Apply an action to a single element (without walking its children)
+    """
+    if type(action) is HandlerTable:
+        handler = action[type(elem)]
+        altered = None if handler is None else handler(elem, doc)
+    else:
+        altered = action(elem, doc)
+    return elem if altered is None else altered
+
+
+def _get_incremental_context(doc, actions, stop_if, fuse, kwargs):
+    """
+    Return everything besides the block itself that the output of a block
+    depends on, as a JSON string (see run_filters)
+    """
+    from .version import __version__
+
+    def describe(obj):
+        if isinstance(obj, partial):
+            return [describe(obj.func), describe(obj.args), describe(obj.keywords)]
+        if isinstance(obj, dict):
+            return sorted([describe(cls), describe(handler)] for cls, handler in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return [describe(item) for item in obj]
+        if hasattr(obj, '__qualname__'):
+            module = getattr(obj, '__module__', None)
+            return [module, obj.__qualname__, _get_module_stamp(module)]
+        return obj
+
+    context = {
+        'version': __version__,
+        'api_version': doc.api_version,
+        'metadata': doc.metadata.content.to_json(),
+        'state': _get_doc_state(doc),
+        'actions': describe(list(actions)),
+        'stop_if': describe(stop_if),
+        'fuse': fuse,
+        'kwargs': describe(kwargs),
+    }
+    # Objects that can't be encoded are described by their repr; if it
+    # includes their address, the blocks are just filtered again
+    return json.dumps(context, sort_keys=True, default=repr)
+
+
+def _get_module_stamp(module):
+    """
+    Return the modification time and size of the file of a module
+    """
+    fn = getattr(sys.modules.get(module), '__file__', None)
+    try:
+        stat = os.stat(fn)
+    except (OSError, TypeError):
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _uses_global_state(action):
+    if callable(action):
+        return getattr(action, 'uses_global_state', False)
+    return any(getattr(handler, 'uses_global_state', False) for handler in action.values())
+
+
+def _apply_actions_in_parallel(doc, actions, stop_if, fuse, kwargs,
+                               processes, merge):
+    """
+    Split the top-level blocks into chunks and apply the actions to each
+    chunk in a process pool, and then to the metadata and the document
+    itself in this process (see run_filters)
+
+    Chunks are sent back and forth as JSON, which is much faster to
+    encode and decode than pickling the elements.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    blocks = doc.content.list
+    num_chunks = min(len(blocks), processes * PARALLEL_CHUNKS_PER_PROCESS)
+    if num_chunks:
+        bounds = [len(blocks) * i // num_chunks for i in range(num_chunks + 1)]
+        state = _get_doc_state(doc)
+
+        with ProcessPoolExecutor(processes) as executor:
+            futures = [executor.submit(_apply_actions_to_chunk,
+                                       ''.join(_iter_json_chunks(doc, blocks[start:end])),
+                                       state, actions, stop_if, fuse, kwargs)
+                       for start, end in zip(bounds, bounds[1:])]
+            results = [future.result() for future in futures]
+
+        # The blocks come from our own JSON, so they don't need to be validated
+        new_blocks = []
+        with trusted_construction():
+            for blocks_json, _ in results:
+                new_blocks.extend(json.loads(blocks_json, object_hook=from_json))
+            doc.content = new_blocks
+
+        if merge is not None:
+            for _, chunk_state in results:
+                merge(doc, chunk_state)
+
+    for action in _prepare_actions(actions, fuse, kwargs):
+        _walk_metadata(action, doc, stop_if)
+        doc = _call_action(action, doc, doc)
+    return doc
+
+
+def _apply_actions_to_chunk(doc_json, state, actions, stop_if, fuse, kwargs):
+    """
+    Runs in a worker process: apply the actions to the blocks of a
+    document holding one chunk of them (but not to its metadata or the
+    document itself, which are filtered once in the parent), and return
+    the resulting blocks (as JSON) together with the attributes of the
+    document
+    """
+    with trusted_construction():
+        doc = json.loads(doc_json, object_hook=from_json)
+    doc.__dict__.update(state)
+
+    for action in _prepare_actions(actions, fuse, kwargs):
+        doc.content = _walk_blocks(doc.content.list, action, doc, stop_if)
+
+    encode = _json_encoder.encode
+    blocks_json = '[' + ','.join(encode(block.to_json()) for block in doc.content.list) + ']'
+    return blocks_json, _get_doc_state(doc)
+
+
+def _get_doc_state(doc):
+    """
+    Return the attributes of a Doc other than its content and metadata
+    (i.e. its format and anything added by filters)
+    """
+    return {key: value for key, value in vars(doc).items()
+            if key not in ('_content', '_metadata')}
+
+
+def _partial_action(action, **kwargs):
+    """
+    Like functools.partial, but keeps the types declared with applies_to()
+    """
+    if not callable(action):
+        return {cls: partial(handler, **kwargs) for cls, handler in action.items()}
+    types = getattr(action, 'applies_to', None)
+    action = partial(action, **kwargs)
+    if types is not None:
+        action.applies_to = types
+    return action
+
+
+def _fuse_actions(actions):
+    """
+    Combine several actions into a single one, so they can all be applied
+    in one walk through the document.
+
+    Each element goes through the actions in order; if an action replaces
+    the element, the next actions are applied to its replacement(s).
+    """
+
+    # Dicts of {class: function} only apply to their keys
+    actions = [(action, getattr(action, 'applies_to', None)) if callable(action)
+               else (HandlerTable(action), tuple(action))
+               for action in actions]
+
+    # For every element type, the actions that apply to it
+    plans = {}
+
+    def get_plan(cls):
+        plan = plans.get(cls)
+        if plan is None:
+            plan = [(i, action) for i, (action, types) in enumerate(actions)
+                    if types is None or issubclass(cls, types)]
+            plans[cls] = plan
+        return plan
+
+    def apply_rest(altered, start, doc):
+        # Slow path: the element was replaced, so we need to apply the
+        # remaining actions to each of the replacements
+        is_list = type(altered) is list
+        elems = altered if is_list else [altered]
+        for action, types in actions[start:]:
+            ans = []
+            for e in elems:
+                res = action(e, doc) if types is None or isinstance(e, types) else None
+                if res is None:
+                    ans.append(e)
+                elif type(res) is list:
+                    ans.extend(res)
+                    is_list = True
+                else:
+                    ans.append(res)
+            elems = ans
+        return elems if is_list else elems[0]
+
+    def fused_action(elem, doc):
+        for i, action in get_plan(type(elem)):
+            altered = action(elem, doc)
+            if altered is not None:
+                return apply_rest(altered, i + 1, doc)
+
+    # If every action declares its types, the walk skips the other
+    # elements without calling fused_action
+    if all(types is not None for _, types in actions):
+        return HandlerTable({cls: fused_action for _, types in actions for cls in types})
+    return fused_action
+
+
+# Same output as json.dumps(doc, default=json_serializer, ...) in one go
+_json_encoder = json.JSONEncoder(
+    default=lambda elem: elem.to_json(),  # Serializer
+    check_circular=False,
+    separators=(',', ':'),  # Compact separators, like Pandoc
+    ensure_ascii=False  # For Pandoc compat
+)
+
+
+def _write_encoded(chunks, output_stream):
+    """
+    Encode text chunks as UTF-8 and write them to a binary stream,
+    grouped into writes of about WRITE_BUFFER_SIZE bytes
+    """
+    pending, size = [], 0
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        pending.append(data)
+        size += len(data)
+        if size >= WRITE_BUFFER_SIZE:
+            output_stream.write(b''.join(pending))
+            pending, size = [], 0
+    if pending:
+        output_stream.write(b''.join(pending))
+
+
+def _iter_json_chunks(doc, blocks=None):
+    """
+    Yield the JSON encoding of a :class:`.Doc` in chunks, so only one
+    top-level block (or metadata field) is converted to JSON at a time.
+
+    Concatenating the chunks gives exactly the same string as encoding
+    ``doc.to_json()`` at once. If *blocks* is given, it is used instead
+    of ``doc.content``.
+    """
+    encode = _json_encoder.encode
+
+    yield '{"pandoc-api-version":' + encode(doc.api_version) + ',"meta":{'
+    sep = ''
+    for key, value in doc.metadata.content.dict.items():
+        yield sep + encode(key) + ':' + encode(to_json_wrapper(value))
+        sep = ','
+
+    yield '},"blocks":['
+    sep = ''
+    for block in (doc.content.list if blocks is None else blocks):
+        yield sep + encode(block.to_json())
+        sep = ','
+    yield ']}'
@@ -0,0 +1,341 @@
+"""
+Persistent filter server for ``panfl``.
+
+Every ``pandoc --filter panfl`` call starts Python, imports panflute and its
+dependencies, and then imports every filter; for small documents this takes
+much longer than running the filters. Instead, ``panfl --serve`` starts a
+long-lived process, listening on a Unix socket, that has all of that already
+imported (including the filters listed in its command line). Pandoc then
+calls the ``panfl-client`` shim, which takes the same arguments as ``panfl``:
+
+    ``pandoc --filter panfl-client``
+
+The shim sends its arguments, working directory and environment to the
+server, together with its standard input, output and error streams (as file
+descriptors), and exits with the status returned by the server. Each
+document is processed in a forked child of the server, so documents are
+handled concurrently, and filters can't leak state from one document to the
+next. If no server is listening, the shim runs ``panfl`` in-process.
+
+The socket is ``$PANFLUTE_SOCKET`` if set, or ``panflute.sock`` in a
+``panflute-<uid>`` folder of ``$XDG_RUNTIME_DIR`` (or ``/tmp``) otherwise.
+As requests include the environment and the client's streams, the folder of
+the socket must be private (a directory owned by the current user, with no
+permissions for others), and, where the platform can tell (``SO_PEERCRED``),
+client and server check that the other end is run by the same user. Only
+available on Unix.
+
+Note: this module only imports the standard library at the top, so the shim
+starts quickly; the rest of panflute is imported when needed.
+"""
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import os
+import sys
+import json
+import array
+import socket
+import stat
+import struct
+import socketserver
+
+
+# ---------------------------
+# Constants
+# ---------------------------
+
+SOCKET_ENV_VAR = 'PANFLUTE_SOCKET'
+
+# Requests start with the length of a JSON header, sent along with the
+# stdin/stdout/stderr file descriptors; responses are the exit status
+LENGTH = struct.Struct('!Q')
+STATUS = struct.Struct('!i')
+NUM_FDS = 3
+
+# struct ucred (pid, uid, gid), returned by SO_PEERCRED
+PEERCRED = struct.Struct('3i')
+
+
+# ---------------------------
+# Functions
+# ---------------------------
+
+def get_socket_path():
+    """
+    Return the path of the Unix socket used by ``panfl --serve``
+    """
+    path = os.environ.get(SOCKET_ENV_VAR)
+    if path:
+        return path
+    folder = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(folder, 'panflute-{}'.format(os.getuid()), 'panflute.sock')
+
+
+def _check_socket_dir(socket_path, create=False):
+    """
+    Check that the folder of the socket is private: a directory (not a
+    symlink) owned by the current user, with no permissions for others.
+
+    :param socket_path: str
+    :param create: bool
+        if True then create the folder (with mode 0700) if it doesn't exist
+    :raises: PermissionError if the folder is not private
+    """
+    folder = os.path.dirname(os.path.abspath(socket_path))
+    if create:
+        try:
+            os.mkdir(folder, 0o700)
+        except FileExistsError:
+            pass
+    info = os.lstat(folder)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+            or info.st_mode & 0o077):
+        raise PermissionError('{} must be a directory owned by the current user '
+                              'and not accessible by others (mode 0700)'.format(folder))
+
+
+def serve(socket_path=None, filters=(), search_dirs=(), data_dir=False,
+          sys_path=True):
+    """
+    Run a persistent filter server until interrupted.
+
+    The filters are found and imported before accepting documents;
+    filters requested later by a document (through its metadata) are
+    imported in the child that handles the document, as are preloaded
+    filters when the document resolves their name to a different file.
+
+    :param socket_path: str or None
+        if None then use :func:`get_socket_path`
+    :param filters: list of str
+        filters to preload (same as in ``panfl``)
+    :param search_dirs: list of str
+    :param data_dir: bool
+    :param sys_path: bool
+    """
+    from .autofilter import expand_search_dirs, resolve_filters, forget_stale_filter
+    from .utils import debug, ContextImport
+
+    if 'FilterServer' not in globals():
+        raise OSError('the filter server requires fork() and Unix sockets')
+
+    if socket_path is None:
+        socket_path = get_socket_path()
+
+    search_dirs = expand_search_dirs(list(search_dirs), data_dir, sys_path,
+                                     panfl_=True)
+    for filter_, filter_path, module_, extra_dir in resolve_filters(
+            list(filters), search_dirs):
+        # Recorded, so children re-import it if a document needs another
+        # file with the same name (see forget_stale_filter)
+        forget_stale_filter(module_, filter_path, extra_dir)
+        with ContextImport(module_, extra_dir):
+            pass
+
+    _check_socket_dir(socket_path, create=True)
+    _remove_stale_socket(socket_path)
+    umask = os.umask(0o177)  # Create the socket with mode 0600
+    try:
+        server = FilterServer(socket_path)
+    finally:
+        os.umask(umask)
+    debug('panflute: serving filters on {}'.format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def client(socket_path=None):
+    """
+    Entry point of ``panfl-client``: forward this invocation to a running
+    ``panfl --serve``, or run ``panfl`` directly if there is none.
+    """
+    if socket_path is None:
+        socket_path = get_socket_path()
+
+    try:
+        _check_socket_dir(socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        if _get_peer_uid(sock) not in (None, os.getuid()):
+            sock.close()
+            raise PermissionError('{} is not served by the current user'.format(socket_path))
+    except (AttributeError, OSError) as e:
+        if isinstance(e, PermissionError):
+            print('panflute: ignoring filter server: {}'.format(e), file=sys.stderr)
+        from .autofilter import panfl
+        panfl(prog_name='panfl')
+        return
+
+    header = json.dumps({
+        'argv': sys.argv[1:],
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+    }).encode('utf-8')
+
+    with sock:
+        _send_fds(sock, LENGTH.pack(len(header)), [0, 1, 2])
+        sock.sendall(header)
+        data = _recv_exactly(sock, STATUS.size)
+
+    if len(data) < STATUS.size:
+        print('panflute: filter server closed the connection', file=sys.stderr)
+        sys.exit(1)
+    sys.exit(STATUS.unpack(data)[0])
+
+
+def _remove_stale_socket(socket_path):
+    """
+    Remove a socket left behind by a server that is no longer running
+    """
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+        else:
+            raise OSError('a filter server is already running on ' + socket_path)
+
+
+def _get_peer_uid(sock):
+    """
+    Return the user id of the process at the other end of a Unix socket,
+    or None if the platform can't tell (no SO_PEERCRED)
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+    return PEERCRED.unpack(creds)[1]
+
+
+def _send_fds(sock, data, fds):
+    """
+    Send bytes together with open file descriptors (SCM_RIGHTS)
+    """
+    fds = array.array('i', fds)
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+def _recv_fds(sock, size, max_fds):
+    """
+    Receive bytes together with open file descriptors (SCM_RIGHTS)
+    """
+    fds = array.array('i')
+    data, ancdata, flags, addr = sock.recvmsg(
+        size, socket.CMSG_SPACE(max_fds * fds.itemsize))
+    for level, type_, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    return data + _recv_exactly(sock, size - len(data)), list(fds)
+
+
+def _recv_exactly(sock, size):
+    """
+    Receive ``size`` bytes, or fewer if the connection is closed
+    """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _exit_status(code):
+    """
+    Convert the argument of :class:`SystemExit` to an exit status
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def _run_panfl(request):
+    """
+    Run ``panfl`` as requested by a client (in a forked child, where
+    fds 0/1/2 already point to the client's streams)
+    """
+    import traceback
+    from .autofilter import panfl
+
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    sys.argv = ['panfl'] + request['argv']
+
+    # Fresh streams over the client's fds (autofilter restores sys.__stdout__)
+    sys.stdin = sys.__stdin__ = open(0, 'r', encoding='utf-8', closefd=False)
+    sys.stdout = sys.__stdout__ = open(1, 'w', encoding='utf-8', closefd=False)
+    sys.stderr = sys.__stderr__ = open(2, 'w', encoding='utf-8',
+                                       errors='backslashreplace', closefd=False)
+
+    try:
+        panfl.main(args=request['argv'], prog_name='panfl')
+        status = 0
+    except SystemExit as e:
+        status = _exit_status(e.code)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+
+    sys.stdout = sys.__stdout__
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            status = status or 1
+    return status
+
+
+# ---------------------------
+# Server
+# ---------------------------
+
+class FilterRequestHandler(socketserver.BaseRequestHandler):
+    """
+    Handle one ``panfl-client`` call (runs in a forked child)
+    """
+    def handle(self):
+        data, fds = _recv_fds(self.request, LENGTH.size, NUM_FDS)
+        if len(data) < LENGTH.size or len(fds) != NUM_FDS:
+            for fd in fds:
+                os.close(fd)
+            return
+        header = _recv_exactly(self.request, LENGTH.unpack(data)[0])
+        request = json.loads(header.decode('utf-8'))
+
+        # Take over the client's stdin/stdout/stderr
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        status = _run_panfl(request)
+        self.request.sendall(STATUS.pack(status))
+
+
+# The server needs fork() and Unix sockets
+if hasattr(socketserver, 'ForkingMixIn') and hasattr(socket, 'AF_UNIX'):
+
+    class FilterServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        """
+        Unix socket server that handles each document in a forked child
+        """
+        def __init__(self, socket_path):
+            super().__init__(socket_path, FilterRequestHandler)
+
+        def verify_request(self, request, client_address):
+            # Only serve clients of the same user
+            return _get_peer_uid(request) in (None, os.getuid())
@@ -8,7 +8,7 @@ Classes corresponding to Pandoc Table elements
 # ---------------------------
 
 from .utils import decode_ica, check_group, check_type, check_type_or_value, encode_dict, debug
-from .containers import ListContainer
+from .containers import ListContainer, invalidate_digest
 from .base import Element, Block, Inline
 
 
@@ -113,6 +113,7 @@ class Table(Block):
 
     @head.setter
     def head(self, value):
+        invalidate_digest(self)
         self._head = check_type(value, TableHead) if value else TableHead()
         self._head.parent = self
         self._head.location = 'head'
@@ -124,6 +125,7 @@ class Table(Block):
 
     @foot.setter
     def foot(self, value):
+        invalidate_digest(self)
         self._foot = check_type(value, TableFoot) if value else TableFoot()
         self._foot.parent = self
         self._foot.location = 'foot'
@@ -135,6 +137,7 @@ class Table(Block):
 
     @caption.setter
     def caption(self, value):
+        invalidate_digest(self)
         if value is None:
             value = Caption()
         self._caption = check_type(value, Caption)
@@ -238,6 +241,7 @@ class TableBody(Block):
 
     @head.setter
     def head(self, value):
+        invalidate_digest(self)
         if value:
             value = value.list if isinstance(value, ListContainer) else list(value)
         else:
@@ -347,6 +351,7 @@ class Caption(Element):
 
     @short_caption.setter
     def short_caption(self, value):
+        invalidate_digest(self)
         if value:
             value = value.list if isinstance(value, ListContainer) else list(value)
             self._short_caption = ListContainer(*value, oktypes=Inline, parent=self)
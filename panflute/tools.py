@@ -7,9 +7,11 @@ Useful (but not essential) functions for writing panflute filters
 # Imports
 # ---------------------------
 
-from .base import Element
+from .base import Element, iter_elements
 from .elements import *
 from .io import dump
+from .utils import trusted_construction, load_json_cache, save_json_cache
+from .cache import convert_cache, shell_cache
 
 import io
 import os
@@ -17,33 +19,20 @@ import os.path as p
 import re
 import sys
 import json
-import yaml
-import shlex
 from typing import Tuple
 
-from shutil import which
-from subprocess import Popen, PIPE
-from functools import partial
+from functools import lru_cache
 
-# yamlloader keeps dict ordering in yaml
-try:
-    import yamlloader
-except ImportError:
-    yamlloader = None
-
-if yamlloader is None:
-    # property of pyyaml:
-    # C*Loader when compiled with C, else fallback to pure Python loader
-    try:
-        from yaml import CSafeLoader as Loader
-    except ImportError:
-        from yaml import SafeLoader as Loader
-else:
-    from yamlloader.ordereddict import CSafeLoader as Loader
+# Note: yaml, shlex, shutil and subprocess are imported on first use,
+# as most filters don't need them
 
 # to be filled when the first time which('pandoc') is called
 PANDOC_PATH = None
 
+# On-disk cache of get_pandoc_info(), with one entry per Pandoc executable
+PANDOC_CACHE_FILE = 'pandoc.json'
+PANDOC_CACHE_SIZE = 16
+
 
 # ---------------------------
 # Constants
@@ -64,6 +53,9 @@ class PandocVersion:
     Get runtime Pandoc version
 
     use PandocVersion().version for comparing versions
+
+    Pandoc is only called the first time this information is needed,
+    and the results are cached on disk (see :func:`get_pandoc_info`).
     '''
 
     def __init__(self):
@@ -77,15 +69,16 @@ class PandocVersion:
 
     @property
     def _repr(self):
-        # lazily call pandoc only once
-        if not hasattr(self, '__repr'):
-            self.__repr: str = run_pandoc(args=['--version'])
-        return self.__repr
+        return get_pandoc_info()['version']
 
     @property
     def version(self) -> Tuple[int, ...]:
         return tuple(int(i) for i in str(self).split('.'))
 
+    @property
+    def api_version(self) -> Tuple[int, ...]:
+        return get_api_version()
+
     @property
     def data_dir(self):
         info = self._repr.splitlines()
@@ -104,10 +97,90 @@ class PandocVersion:
 pandoc_version = PandocVersion()
 
 
+@lru_cache(maxsize=None)
+def get_pandoc_info(pandoc_path=None):
+    """
+    Return a dict with the output of ``pandoc --version`` (key ``version``)
+    and the Pandoc API version (key ``api_version``).
+
+    Results are cached in memory and on disk, keyed by the path,
+    modification time and size of the Pandoc executable (and by the
+    variables that set the user data directory), so Pandoc only needs to
+    be called again after it is updated.
+
+    :param str pandoc_path: If specified, use the Pandoc at this path.
+        If None, default to that from PATH.
+    :rtype: :class:`dict`
+    """
+    if pandoc_path is None:
+        pandoc_path = get_pandoc_path()
+
+    try:
+        real_path = p.realpath(pandoc_path)
+        stat = os.stat(real_path)
+        key = json.dumps([real_path, stat.st_mtime_ns, stat.st_size,
+                          os.environ.get('HOME'), os.environ.get('XDG_DATA_HOME')])
+    except OSError:
+        raise OSError(f"Given pandoc_path {pandoc_path} is invalid")
+
+    cache = load_json_cache(PANDOC_CACHE_FILE)
+    info = cache.get(key)
+    if info is None:
+        # Not through convert_text(), as its cache depends on this
+        out = run_pandoc('', args=['--from=markdown', '--to=json'], pandoc_path=pandoc_path)
+        info = {'version': run_pandoc(args=['--version'], pandoc_path=pandoc_path),
+                'api_version': json.loads(out)['pandoc-api-version']}
+        cache[key] = info
+        while len(cache) > PANDOC_CACHE_SIZE:
+            del cache[next(iter(cache))]
+        save_json_cache(PANDOC_CACHE_FILE, cache)
+    return info
+
+
+def get_pandoc_path():
+    """
+    Return the path of the Pandoc executable in PATH
+    (only searched for once)
+    """
+    if PANDOC_PATH is None:
+        from shutil import which
+        temp = which('pandoc')
+        if temp is None:
+            raise OSError("Path to pandoc executable does not exists")
+        sys.modules[__name__].PANDOC_PATH = temp
+    return PANDOC_PATH
+
+
 # ---------------------------
 # Convenience functions
 # ---------------------------
 
+@lru_cache(maxsize=None)
+def _get_yaml():
+    """
+    Import yaml on first use, and return it along with the loader to use
+    """
+    import yaml
+
+    # yamlloader keeps dict ordering in yaml
+    try:
+        import yamlloader
+    except ImportError:
+        yamlloader = None
+
+    if yamlloader is None:
+        # property of pyyaml:
+        # C*Loader when compiled with C, else fallback to pure Python loader
+        try:
+            from yaml import CSafeLoader as Loader
+        except ImportError:
+            from yaml import SafeLoader as Loader
+    else:
+        from yamlloader.ordereddict import CSafeLoader as Loader
+
+    return yaml, Loader
+
+
 def yaml_filter(element, doc, tag=None, function=None, tags=None,
                 strict_yaml=False):
     '''
@@ -176,6 +249,7 @@ def yaml_filter(element, doc, tag=None, function=None, tags=None,
         for tag in tags:
             if tag in element.classes:
                 function = tags[tag]
+                yaml, Loader = _get_yaml()
 
                 if not strict_yaml:
                     # Split YAML and data parts (separated by ... or ---)
@@ -251,7 +325,7 @@ def stringify(element, newlines=True):
     def stop_if(e):
         return isinstance(e, (DefinitionList, Cite))
 
-    def attach_str(e, doc, answer):
+    def get_str(e):
         if hasattr(e, 'text'):
             ans = e.text
         elif isinstance(e, HorizontalSpaces):
@@ -277,12 +351,10 @@ def stringify(element, newlines=True):
             if e.index == len(e.container) - 1:
                 ans += '"'
 
-        answer.append(ans)
+        return ans
 
-    answer = []
-    f = partial(attach_str, answer=answer)
-    element.walk(f, stop_if=stop_if)
-    return ''.join(answer)
+    # Read-only iteration, so the element is not modified
+    return ''.join(get_str(e) for e in iter_elements(element, stop_if=stop_if))
 
 
 def _get_metadata(self, key='', default=None, builtin=True):
@@ -351,17 +423,38 @@ Doc.get_metadata = _get_metadata
 # Functions that rely on external calls
 # ---------------------------
 
-def shell(args, wait=True, msg=None):
+def shell(args, wait=True, msg=None, cache=False, cache_binary=True):
     """
     Execute the external command and get its exitcode, stdout and stderr.
+
+    :param cache: if True, reuse the output of previous calls with the same
+        arguments and input (across runs; see :mod:`panflute.cache`).
+        Only use it for commands whose output depends on nothing else,
+        such as diagram renderers that write to stdout.
+    :param cache_binary: if True (default), a cached output is only reused
+        if the executable has not changed since (same path, modification
+        time and size)
     """
 
+    import shlex
+    from subprocess import Popen, PIPE
+
     # Fix Windows error if passed a string
     if isinstance(args, str):
         args = shlex.split(args, posix=(os.name != "nt"))
         if os.name == "nt":
             args = [arg.replace('/', '\\') for arg in args]
 
+    if wait and cache and not shell_cache.is_disabled():
+        args = [os.fsdecode(arg) for arg in args]  # Such as pathlib.Path or bytes
+        binary = _get_binary_identity(args[0]) if cache_binary else None
+        key = shell_cache.key(args, msg or b'', binary)
+        out = shell_cache.get(key)
+        if out is None:
+            out = shell(args, msg=msg)
+            shell_cache.set(key, out)
+        return out
+
     if wait:
         proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
         out, err = proc.communicate(input=msg)
@@ -377,6 +470,19 @@ def shell(args, wait=True, msg=None):
         proc = Popen(args, creationflags=DETACHED_PROCESS)
 
 
+def _get_binary_identity(name):
+    """
+    Return the path, modification time and size of an executable
+    """
+    from shutil import which
+    path = which(name)
+    if path is None:
+        return None
+    path = p.realpath(path)
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
 def run_pandoc(text='', args=None, pandoc_path=None):
     """
     Low level function that calls Pandoc with (optionally)
@@ -385,16 +491,12 @@ def run_pandoc(text='', args=None, pandoc_path=None):
     :param str pandoc_path: If specified, use the Pandoc at this path.
         If None, default to that from PATH.
     """
+    from subprocess import Popen, PIPE
+
     if args is None:
         args = []
     if pandoc_path is None:
-        # initialize the global PANDOC_PATH
-        if PANDOC_PATH is None:
-            temp = which('pandoc')
-            if temp is None:
-                raise OSError("Path to pandoc executable does not exists")
-            sys.modules[__name__].PANDOC_PATH = temp
-        pandoc_path = PANDOC_PATH
+        pandoc_path = get_pandoc_path()
 
     try:
         proc = Popen([pandoc_path] + args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
@@ -451,6 +553,12 @@ def convert_text(text,
         If None, default to that from PATH.
     :rtype: :class:`list` | :class:`.Doc` | :class:`str`
 
+    Note: with ``$PANFLUTE_CACHE=1`` (see :mod:`panflute.cache`), the output
+    of Pandoc is cached, keyed by the text, formats, extra arguments and
+    Pandoc version. Don't use it if the conversion depends on files that
+    might change (such as templates or bibliographies passed in
+    *extra_args*).
+
     Note: for a more general solution,
     see `pyandoc <https://github.com/kennethreitz/pyandoc/>`_
     by Kenneth Reitz.
@@ -464,8 +572,7 @@ def convert_text(text,
         #  (remember that Pandoc requires a matching api-version!)
         # Workaround: call Pandoc with empty text to get its api-version
         if not isinstance(text, Doc):
-            tmp_doc = convert_text('', standalone=True)
-            api_version = tmp_doc.api_version
+            api_version = get_api_version(pandoc_path)
             if isinstance(text, Element):
                 text = [text]
             text = Doc(*text, api_version=api_version)
@@ -487,7 +594,8 @@ def convert_text(text,
     out = inner_convert_text(text, in_fmt, out_fmt, extra_args, pandoc_path=pandoc_path)
 
     if output_format == 'panflute':
-        out = json.loads(out, object_hook=from_json)
+        with trusted_construction():
+            out = json.loads(out, object_hook=from_json)
 
         if standalone:
             if not isinstance(out, Doc):  # Pandoc 1.7.2 and earlier
@@ -502,13 +610,102 @@ def convert_text(text,
     return out
 
 
+def convert_text_many(texts,
+                      input_format='markdown',
+                      extra_args=None,
+                      pandoc_path=None):
+    r"""
+    Convert several snippets of formatted text (usually markdown) into
+    lists of Pandoc elements, calling Pandoc only once.
+
+    This gives the same results as calling :func:`convert_text` on each
+    snippet (with the default ``output_format='panflute'``), but starting
+    a single Pandoc process instead of one per snippet. The snippets are
+    joined into one document, separated by paragraphs with a unique
+    sentinel string, and the resulting blocks are split at those paragraphs.
+
+    If a snippet swallows a separator (e.g. an unclosed code block),
+    the snippets are converted one by one instead.
+
+    Note: as the snippets are converted as a single document,
+    Pandoc makes the identifiers of headers unique across all the snippets,
+    and reference links and footnotes can be shared between them.
+
+    Example:
+
+        >>> from panflute import *
+        >>> convert_text_many(['*a*', 'b\n\nc'])
+        [[Para(Emph(Str(a)))], [Para(Str(b)), Para(Str(c))]]
+
+    :param texts: snippets of text that will be converted
+    :type texts: :class:`list` of :class:`str`
+    :param input_format: format of the text (default 'markdown');
+     any Pandoc input format is valid
+    :param extra_args: extra arguments passed to Pandoc
+    :type extra_args: :class:`list`
+    :param str pandoc_path: If specified, use the Pandoc at this path.
+        If None, default to that from PATH.
+    :rtype: :class:`list` of :class:`list` of :class:`.Block`
+    """
+
+    def convert_each():
+        return [convert_text(text, input_format, extra_args=extra_args, pandoc_path=pandoc_path)
+                for text in texts]
+
+    texts = list(texts)
+    if len(texts) < 2:
+        return convert_each()
+
+    # Random, so it doesn't appear in the texts
+    separator = 'panflutesnippet' + os.urandom(16).hex()
+    blocks = convert_text(('\n\n' + separator + '\n\n').join(texts),
+                          input_format, extra_args=extra_args, pandoc_path=pandoc_path)
+
+    ans = [[]]
+    for block in blocks:
+        if type(block) in (Para, Plain) and len(block.content) == 1 \
+                and type(block.content.list[0]) is Str and block.content.list[0].text == separator:
+            ans.append([])
+        else:
+            ans[-1].append(block)
+
+    if len(ans) != len(texts):
+        return convert_each()
+    return ans
+
+
+def get_api_version(pandoc_path=None):
+    """
+    Return the version of the Pandoc API used by Pandoc,
+    which is needed to build Pandoc documents
+    (cached, see :func:`get_pandoc_info`).
+
+    :param str pandoc_path: If specified, use the Pandoc at this path.
+        If None, default to that from PATH.
+    :rtype: :class:`tuple`
+    """
+    return tuple(get_pandoc_info(pandoc_path)['api_version'])
+
+
 def inner_convert_text(text, input_format, output_format, extra_args, pandoc_path=None):
     # like convert_text(), but does not support 'panflute' input/output
     from_arg = '--from={}'.format(input_format)
     to_arg = '--to={}'.format(output_format)
     args = [from_arg, to_arg] + extra_args
+
+    # Optionally reuse the output of previous conversions (see panflute.cache)
+    use_cache = convert_cache.is_enabled()
+    if use_cache:
+        key = convert_cache.key(text, args, get_pandoc_info(pandoc_path)['version'])
+        out = convert_cache.get(key)
+        if out is not None:
+            return out.decode('utf-8')
+
     out = run_pandoc(text, args, pandoc_path=pandoc_path)
     out = "\n".join(out.splitlines())  # Replace \r\n with \n
+
+    if use_cache:
+        convert_cache.set(key, out.encode('utf-8'))
     return out
 
 
@@ -558,13 +755,10 @@ def _replace_keyword(self, keyword, replacement, count=0):
     :type count: :class:`int`
     """
 
-    def replace_with_inline(e, doc):
-        if type(e) == Str and e.text == keyword:
-            doc.num_matches += 1
-            if not count or doc.num_matches <= count:
-                return replacement
+    def is_keyword(e):
+        return type(e) == Str and e.text == keyword
 
-    def replace_with_block(e, doc):
+    def replace_with_block(e):
         '''
         It's difficult to replace a keyword with an entire Block element.
 
@@ -577,8 +771,8 @@ def _replace_keyword(self, keyword, replacement, count=0):
         1) If the Str that contains the keyword is inside another
            Inline instead of a Block (e.g. Div -> Emph -> Str)
            then we have to do a trick:
-           when .walk() touches an Emph that contains Str(keyword),
-           it replaces the Emph with Str(keyword).
+           when we reach an Emph that contains Str(keyword),
+           we replace the Emph with Str(keyword).
 
         2) If the element that contains the Str(keyword) has multiple children,
            then we are in a bind as replacing it will destroy information.
@@ -587,34 +781,43 @@ def _replace_keyword(self, keyword, replacement, count=0):
         3) If the element that contains the Str(keyword) does so in a DictContainer
            instead of a ListContainer, then we cannot retrieve the "first and only
            element" easily, so we also abort (happens with metadata elements).
+
+        Returns the new element (or None if nothing needs to be replaced)
         '''
 
         # Here we can check that e.content is ListContainer (i.e. not DictContainer)
         # or check that e is not a Metavalue ("not isinstance(e, MetaValue)")
 
         if hasattr(e, 'content') and isinstance(e.content, ListContainer) and len(e.content) == 1:
-            ee = e.content[0]
-            if type(ee) == Str and ee.text == keyword:
+            if is_keyword(e.content.list[0]):
                 if isinstance(e, Block):
-                    doc.num_matches += 1
-                    if not count or doc.num_matches <= count:
-                        return replacement
+                    return replacement
                 elif isinstance(e, Inline):
                     return Str(keyword)
-            else:
-                pass  # not implemented
 
-    doc = self.doc
-    if doc is None:
-        raise Exception('No root document')
-    doc.num_matches = 0
     if isinstance(replacement, Inline):
-        return self.walk(replace_with_inline, doc)
+        types, get_replacement = Str, lambda e: replacement if is_keyword(e) else None
     elif isinstance(replacement, Block):
-        return self.walk(replace_with_block, doc)
+        types, get_replacement = None, replace_with_block
     else:
         raise NotImplementedError(type(replacement))
 
+    # The elements are replaced in their containers while we iterate;
+    # this is safe as iter_descendants() is post-order and only moves forward
+    num_matches = 0
+    for e in self.iter_descendants(types, include_self=True):
+        new = get_replacement(e)
+        if new is None:
+            continue
+        if new is replacement:
+            num_matches += 1
+            if count and num_matches > count:
+                break
+        if e is self:
+            return new
+        e.container[e.index] = new
+    return self
+
 
 # Bind the method
 Element.replace_keyword = _replace_keyword
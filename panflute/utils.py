@@ -6,13 +6,24 @@ Auxiliary functions that have no dependencies
 # Imports
 # ---------------------------
 
+import gc
 import os
 import sys
 import json
+import threading
 import os.path as p
+from contextlib import contextmanager
 from importlib import import_module
 
 
+# ---------------------------
+# Constants
+# ---------------------------
+
+# Turns the on-disk caches on (1) or off (0); see cache_disabled()
+CACHE_ENV_VAR = 'PANFLUTE_CACHE'
+
+
 # ---------------------------
 # Functions
 # ---------------------------
@@ -57,6 +68,10 @@ def get_caller_name():
 
 
 def check_type(value, oktypes):
+    # Trees built from trusted input are not validated
+    if construction.trusted:
+        return value
+
     # This allows 'Space' instead of 'Space()'
     if callable(value):
         value = value()
@@ -72,6 +87,8 @@ def check_type(value, oktypes):
 
 
 def check_group(value, group):
+    if construction.trusted:
+        return value
     if value not in group:
         tag = type(value).__name__
         msg = 'element {} not in group {}'.format(tag, repr(group))
@@ -81,6 +98,9 @@ def check_group(value, group):
 
 
 def check_type_or_value(value, oktypes, okvalue):
+    if construction.trusted:
+        return value
+
     # This allows 'Space' instead of 'Space()'
     if callable(value):
         value = value()
@@ -130,10 +150,155 @@ def load_pandoc_reader_options():
     return dict()
 
 
+def get_cache_dir():
+    """
+    Return the folder where panflute keeps its on-disk caches
+    (it might not exist yet).
+
+    This is ``$PANFLUTE_CACHE_DIR`` if set, or a ``panflute`` subfolder of
+    the user cache folder (``$XDG_CACHE_HOME``, ``~/.cache``, or
+    ``%LOCALAPPDATA%`` on Windows). Set ``$PANFLUTE_CACHE`` to ``0``
+    to turn off every cache (see :func:`cache_disabled`).
+    """
+    path = os.environ.get('PANFLUTE_CACHE_DIR')
+    if path:
+        return path
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or p.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or p.join(p.expanduser('~'), '.cache')
+    return p.join(base, 'panflute')
+
+
+def cache_disabled():
+    """
+    Return True if ``$PANFLUTE_CACHE`` is ``0`` (or ``false``, ``no``,
+    ``off``), so panflute neither reads nor writes its on-disk caches
+    """
+    return os.environ.get(CACHE_ENV_VAR, '').lower() in ('0', 'false', 'no', 'off')
+
+
+def load_json_cache(name):
+    """
+    Load a dict saved with :func:`save_json_cache`; return an empty dict
+    if it doesn't exist or can't be read, or if caches are disabled.
+    """
+    if cache_disabled():
+        return {}
+    try:
+        with open(p.join(get_cache_dir(), name), encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save_json_cache(name, data):
+    """
+    Save a dict as a JSON file in the cache folder. The file is replaced
+    atomically, so concurrent runs never see it half-written; failures
+    are ignored (caches are optional).
+    """
+    if cache_disabled():
+        return
+    folder = get_cache_dir()
+    fn = p.join(folder, name)
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    try:
+        os.makedirs(folder, exist_ok=True)
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, fn)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+@contextmanager
+def trusted_construction():
+    """
+    Context manager used internally to build element trees from trusted
+    input, such as the JSON produced by Pandoc (in :func:`.load` and
+    :func:`.convert_text`) or copies of existing trees.
+
+    Inside it:
+
+    - :func:`check_type` and related functions return their input as is,
+      so element constructors don't validate their arguments. In particular,
+      ``Space`` is **not** converted into ``Space()``.
+    - Containers take their items without validating them one by one.
+    - The cyclic garbage collector is paused, as it would otherwise
+      repeatedly scan the tree while it is being built (see
+      :func:`pause_gc`; as the collector is shared by all threads, it
+      is resumed when the last thread leaves this mode).
+
+    Elements constructed outside of it (e.g. by filters) are validated
+    as usual. The mode is thread-local, so it doesn't affect elements
+    that other threads construct at the same time.
+
+    Example:
+
+        >>> from panflute.utils import trusted_construction
+        >>> with trusted_construction():
+        >>>     para = Para(*inlines)  # inlines must be valid Inline elements
+    """
+    previous = construction.trusted
+    construction.trusted = True
+    try:
+        if previous:
+            yield
+        else:
+            with pause_gc():
+                yield
+    finally:
+        construction.trusted = previous
+
+
+# The garbage collector is process-wide, so pauses are counted across
+# threads, and only the last one to finish resumes it (see pause_gc)
+_gc_lock = threading.Lock()
+_gc_pauses = 0
+_gc_was_enabled = False
+
+
+@contextmanager
+def pause_gc():
+    """
+    Context manager that pauses the cyclic garbage collector, and restores
+    its previous state once every (possibly overlapping) pause has ended
+    """
+    global _gc_pauses, _gc_was_enabled
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if _gc_pauses == 0 and _gc_was_enabled:
+                gc.enable()
+
+
 # ---------------------------
 # Classes
 # ---------------------------
 
+class ConstructionState(threading.local):
+    """
+    Per-thread flags that control how elements are constructed
+    (see :func:`trusted_construction`)
+    """
+    trusted = False
+
+
+construction = ConstructionState()
+
+
 class ContextImport:
     """
     Import module context manager.
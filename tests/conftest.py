@@ -0,0 +1,26 @@
+"""
+Shared pytest configuration
+"""
+
+import os
+import tempfile
+
+# Keep the on-disk caches of the tests (including those written by panfl
+# and pandoc subprocesses, and while collecting tests) out of the user's
+# cache folder
+_cache_dir = tempfile.TemporaryDirectory(prefix='panflute-cache-')
+_old_cache_dir = None
+
+
+def pytest_configure(config):
+    global _old_cache_dir
+    _old_cache_dir = os.environ.get('PANFLUTE_CACHE_DIR')
+    os.environ['PANFLUTE_CACHE_DIR'] = _cache_dir.name
+
+
+def pytest_unconfigure(config):
+    if _old_cache_dir is None:
+        os.environ.pop('PANFLUTE_CACHE_DIR', None)
+    else:
+        os.environ['PANFLUTE_CACHE_DIR'] = _old_cache_dir
+    _cache_dir.cleanup()
@@ -93,7 +93,58 @@ def test_stringify():
 
 
 
+def test_binary_streams():
+	import io
+	import subprocess
+	import sys
+
+	doc = pf.Doc(pf.Para(pf.Str('Ünïcödé'), pf.Space, pf.Str('text')))
+	text = io.StringIO()
+	pf.dump(doc, text)
+
+	# Binary input and output streams
+	binary = io.BytesIO()
+	pf.dump(doc, binary)
+	assert binary.getvalue().decode('utf-8') == text.getvalue()
+	assert pf.load(io.BytesIO(binary.getvalue())) == doc
+
+	# stdin/stdout; dump() can be called twice without breaking sys.stdout
+	code = 'import panflute as pf; doc = pf.load(); pf.dump(doc); print(); pf.dump(doc)'
+	out = subprocess.run([sys.executable, '-c', code], input=binary.getvalue(),
+						 stdout=subprocess.PIPE, check=True).stdout
+	assert out.decode('utf-8') == text.getvalue() + '\n' + text.getvalue()
+
+
+
+def test_lazy_imports():
+	import subprocess
+	import sys
+
+	# Filters that don't use the command line interface, YAML or subprocesses
+	# should not import them, not even through "from panflute import *"
+	unused = '{"click", "yaml", "subprocess", "shlex"}'
+	for statement in ('import panflute', 'from panflute import *'):
+		code = f'import sys; {statement}; assert not {unused} & set(sys.modules)'
+		subprocess.run([sys.executable, '-c', code], check=True)
+
+	# The command line functions are loaded on first use
+	code = ('import sys, panflute; panflute.panfl; '
+			'assert "click" in sys.modules and "panfl" in dir(panflute)')
+	subprocess.run([sys.executable, '-c', code], check=True)
+
+
+def test_star_import():
+	# Everything but the (lazily loaded) command line functions is exported
+	namespace = {}
+	exec('from panflute import *', namespace)
+	assert {'Para', 'run_filters', 'convert_text'} <= set(namespace)
+	assert not {'main', 'panfl', 'get_filter_dirs', 'stdio'} & set(namespace)
+	assert pf.panfl is not None
+
+
+
 if __name__ == "__main__":
     test_idempotence_of_native()
     test_idempotence()
     test_stringify()
+    test_binary_streams()
@@ -0,0 +1,358 @@
+"""
+Benchmarks of panflute internals against the implementations they replaced
+
+Besides checking that both give the same results, these print timings.
+They are slow, so they only run when requested:
+``pytest -m benchmark -s tests/test_benchmarks.py``
+"""
+
+# ---------------------------
+# Imports
+# ---------------------------
+
+import io
+import sys
+import copy
+import json
+import time
+import tracemalloc
+import subprocess
+from itertools import chain
+
+import pytest
+
+import panflute as pf
+from panflute.elements import _res_func, SPECIAL_ELEMENTS
+
+
+pytestmark = pytest.mark.benchmark
+
+
+# ---------------------------
+# Helpers
+# ---------------------------
+
+def timeit(fn, setup=None, repeat=3):
+    """Return the best time of fn(setup()) and its last result"""
+    best = float('inf')
+    for _ in range(repeat):
+        arg = None if setup is None else setup()
+        start = time.perf_counter()
+        ans = fn() if setup is None else fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best, ans
+
+
+def report(name, old, new, unit='ms', scale=1000):
+    print(f'{name}: {old * scale:.1f}{unit} -> {new * scale:.1f}{unit} ({old / new:.1f}x)')
+
+
+def make_wide_doc(n=2000):
+    paras = [pf.Para(pf.Str('Lorem'), pf.Space, pf.Emph(pf.Str('ipsum'), pf.Space, pf.Str(str(i))),
+                     pf.SoftBreak, pf.Link(pf.Str('dolor'), url='#sit'), pf.Str('.'))
+             for i in range(n)]
+    return pf.Doc(*paras, pf.BulletList(*[pf.ListItem(pf.Plain(pf.Str(str(i)))) for i in range(n)]),
+                  metadata={'title': 'Wide', 'tags': ['a', 'b', 'c']})
+
+
+def to_json_text(doc):
+    with io.StringIO() as f:
+        pf.dump(doc, f)
+        return f.getvalue()
+
+
+def make_deep_doc(depth=2000):
+    block = pf.Para(pf.Str('bottom'))
+    for i in range(depth):
+        block = pf.BlockQuote(block) if i % 2 else pf.Div(block)
+    return pf.Doc(block)
+
+
+# ---------------------------
+# Walk
+# ---------------------------
+
+def recursive_walk(self, action, doc=None, stop_if=None):
+    """Element.walk() before it used an explicit stack"""
+    if stop_if is None or not stop_if(self):
+        children = ((child_name, getattr(self, child_name)) for child_name in self._children)
+        for child_name, child in children:
+            if isinstance(child, pf.ListContainer):
+                child = recursive_list_walk(child, action, doc, stop_if)
+            elif isinstance(child, pf.DictContainer):
+                child = recursive_dict_walk(child, action, doc, stop_if)
+            elif isinstance(child, pf.Element):
+                child = recursive_walk(child, action, doc, stop_if)
+            setattr(self, child_name, child)
+    altered = action(self, doc)
+    return self if altered is None else altered
+
+
+def recursive_list_walk(self, action, doc=None, stop_if=None):
+    ans = (recursive_walk(item, action, doc, stop_if) for item in self)
+    ans = ((item,) if type(item) is not list else item for item in ans)
+    return list(chain.from_iterable(ans))
+
+
+def recursive_dict_walk(self, action, doc=None, stop_if=None):
+    ans = ((k, recursive_walk(v, action, doc, stop_if)) for k, v in self.items())
+    return [(k, v) for k, v in ans if v != []]
+
+
+def upper_str(elem, doc):
+    if isinstance(elem, pf.Str):
+        return pf.Str(elem.text.upper())
+
+
+def test_walk_benchmark():
+    old, old_doc = timeit(lambda doc: recursive_walk(doc, upper_str), make_wide_doc)
+    new, new_doc = timeit(lambda doc: doc.walk(upper_str), make_wide_doc)
+    assert old_doc == new_doc
+    report('walk (wide doc)', old, new)
+
+    depth = 100  # Kept low so the recursive walk (and ==) do not fail
+    make_doc = lambda: make_deep_doc(depth)
+    old, old_doc = timeit(lambda doc: recursive_walk(doc, upper_str), make_doc)
+    new, new_doc = timeit(lambda doc: doc.walk(upper_str), make_doc)
+    assert old_doc == new_doc
+    report('walk (deep doc)', old, new)
+
+
+def test_read_only_walk_benchmark():
+    def count_str(elem, doc):
+        if isinstance(elem, pf.Str):
+            doc.count += 1
+
+    def read_only(walk_fn, doc):
+        doc.count = 0
+        walk_fn(doc, count_str, doc)
+        return doc.count
+
+    old, old_count = timeit(lambda doc: read_only(recursive_walk, doc), make_wide_doc)
+    new, new_count = timeit(lambda doc: read_only(pf.Doc.walk, doc), make_wide_doc)
+    assert old_count == new_count
+    report('walk (read-only)', old, new)
+
+
+def test_iteration_benchmark():
+    from collections.abc import MutableSequence
+
+    def iterate(doc):
+        return sum(1 for block in doc.content for inline in block.content)
+
+    old_iter = pf.ListContainer.__iter__
+    try:
+        pf.ListContainer.__iter__ = MutableSequence.__iter__  # Through __getitem__
+        old, old_count = timeit(iterate, make_wide_doc)
+    finally:
+        pf.ListContainer.__iter__ = old_iter
+    new, new_count = timeit(iterate, make_wide_doc)
+    assert old_count == new_count
+    report('iterate (wide doc)', old, new)
+
+
+def merge_adjacent_str(para):
+    """Merge consecutive Str elements, looking ahead with .next"""
+    elem = para.content[0]
+    while elem is not None:
+        following = elem.next
+        if isinstance(elem, pf.Str) and isinstance(following, pf.Str):
+            elem.text += following.text
+            del para.content[following.index]
+        else:
+            elem = following
+    return para
+
+
+def test_sibling_navigation_benchmark():
+    para = pf.Para(pf.Str('a'), pf.Str('b'), pf.Space, pf.Str('c'), pf.Str('d'), pf.Str('e'))
+    merge_adjacent_str(para)
+    assert para == pf.Para(pf.Str('ab'), pf.Space, pf.Str('cde'))
+    assert para.content[-1].prev.index == 1
+
+    def eager_invalidate_indexes(self, start):
+        """Renumber right away, as ListContainer did before indexes were updated lazily"""
+        self.stale = start
+        self._renumber()
+
+    def make_para(n=6000):
+        return pf.Para(*[pf.Str(str(i)) if i % 3 else pf.Space for i in range(n)])
+
+    lazy_invalidate_indexes = pf.ListContainer._invalidate_indexes
+    try:
+        pf.ListContainer._invalidate_indexes = eager_invalidate_indexes
+        old, old_para = timeit(merge_adjacent_str, make_para)
+    finally:
+        pf.ListContainer._invalidate_indexes = lazy_invalidate_indexes
+    new, new_para = timeit(merge_adjacent_str, make_para)
+    assert old_para == new_para
+    report('merge adjacent Str (with .next)', old, new)
+
+
+# ---------------------------
+# Load
+# ---------------------------
+
+def old_from_json(data):
+    """from_json() before the decoding fast path"""
+    if 'unMeta' in data:
+        assert len(data) == 1
+        return pf.MetaMap(*data['unMeta'].items())
+    if 'pandoc-api-version' in data:
+        assert len(data) == 3
+        return pf.Doc(*data['blocks'], api_version=data['pandoc-api-version'], metadata=data['meta'])
+    if 't' not in data:
+        return data
+    assert (len(data) == 1) or (len(data) == 2 and 'c' in data)
+    tag = data['t']
+    c = data.get('c')
+    if tag in _res_func:
+        return _res_func[tag](c)
+    elif tag in SPECIAL_ELEMENTS:
+        return tag
+    else:
+        raise NotImplementedError(f'Unknown tag: {tag}')
+
+
+def test_load_benchmark():
+    raw = to_json_text(make_wide_doc(5000))
+    old, old_doc = timeit(lambda: json.loads(raw, object_hook=old_from_json))
+    new, new_doc = timeit(lambda: pf.load(io.StringIO(raw)))
+    assert old_doc == new_doc
+    assert to_json_text(new_doc) == raw
+    report(f'load ({len(raw) // 1024}KB)', old, new)
+
+
+def retained_memory(fn):
+    tracemalloc.start()
+    ans = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, ans
+
+
+def test_compact_load_benchmark():
+    words = 'lorem ipsum dolor sit amet consectetur adipiscing elit'.split()
+    paras = [pf.Para(*[elem for j in range(100) for elem in (pf.Str(words[(i + j) % 8]), pf.Space)])
+             for i in range(1000)]
+
+    # Text is packed; documents with more than text share their empty elements
+    for name, doc in (('text', pf.Doc(*paras)), ('wide doc', make_wide_doc(5000))):
+        raw = to_json_text(doc)
+        old, old_doc = retained_memory(lambda: pf.load(io.StringIO(raw)))
+        new, new_doc = retained_memory(lambda: pf.load(io.StringIO(raw), compact=True))
+        assert old_doc == new_doc
+        report(f'load (memory, {name})', old, new, unit='MB', scale=1e-6)
+        assert new < old
+
+        old, _ = timeit(lambda: pf.load(io.StringIO(raw)))
+        new, _ = timeit(lambda: pf.load(io.StringIO(raw), compact=True))
+        report(f'load (time, {name})', old, new)
+
+
+# ---------------------------
+# Dump
+# ---------------------------
+
+def old_dump(doc, output_stream):
+    """dump() before it streamed the output"""
+    output_stream.write(json.dumps(obj=doc, default=lambda elem: elem.to_json(),
+                                   check_circular=False, separators=(',', ':'),
+                                   ensure_ascii=False))
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+class NullWriter:
+    def write(self, text):
+        pass
+
+
+def test_dump_benchmark():
+    # A few big blocks, such as paragraphs with images embedded as data URIs
+    data = 'data:image/png;base64,' + 'A' * 1_000_000
+    doc = make_wide_doc(2000)
+    doc.content.extend(pf.Para(pf.Image(url=data + str(i))) for i in range(10))
+
+    with io.StringIO() as f:
+        old_dump(doc, f)
+        old_text = f.getvalue()
+    assert to_json_text(doc) == old_text
+
+    old, _ = timeit(lambda: old_dump(doc, NullWriter()))
+    new, _ = timeit(lambda: pf.dump(doc, NullWriter()))
+    report('dump (time)', old, new)
+
+    old = peak_memory(lambda: old_dump(doc, NullWriter()))
+    new = peak_memory(lambda: pf.dump(doc, NullWriter()))
+    report('dump (peak memory)', old, new, unit='MB', scale=1e-6)
+    assert new < old
+
+
+# ---------------------------
+# Equality
+# ---------------------------
+
+def test_equality_benchmark():
+    doc_a, doc_b = make_wide_doc(), make_wide_doc()
+    old, old_ans = timeit(lambda: doc_a == doc_b)
+    first, _ = timeit(lambda: (doc_a.digest(), doc_b.digest()), repeat=1)
+    new, new_ans = timeit(lambda: doc_a.digest() == doc_b.digest())
+    assert old_ans and new_ans
+    report('== vs. cached digests (wide doc)', old, new)
+    report('== vs. digests (wide doc, including the first digest)', old, first + new)
+
+    # Only the changed block and its ancestors are hashed again
+    doc_b.content[-2].content[0].text = 'changed'
+    doc_b.content[-2].content[0].reset_digest()
+    again, _ = timeit(doc_b.digest, repeat=1)
+    assert doc_a != doc_b
+    report('digest (after changing one block)', first / 2, again)
+
+
+# ---------------------------
+# Clone
+# ---------------------------
+
+def test_clone_benchmark():
+    doc = make_wide_doc()
+    old, old_doc = timeit(lambda: copy.deepcopy(doc))
+    new, new_doc = timeit(doc.clone)
+    assert old_doc == new_doc == doc
+    report('clone (wide doc)', old, new)
+
+
+# ---------------------------
+# Convert text
+# ---------------------------
+
+def test_convert_text_many_benchmark():
+    texts = [f'Cell *{i}* with [a link](http://example.com/{i})' for i in range(50)]
+    old, old_ans = timeit(lambda: [pf.convert_text(text) for text in texts], repeat=1)
+    new, new_ans = timeit(lambda: pf.convert_text_many(texts), repeat=1)
+    assert old_ans == new_ans
+    report(f'convert_text ({len(texts)} snippets)', old, new)
+
+
+# ---------------------------
+# Import
+# ---------------------------
+
+def import_time(code):
+    """Best wall time of running code in a fresh interpreter"""
+    best, _ = timeit(lambda: subprocess.run([sys.executable, '-c', code], check=True), repeat=5)
+    return best
+
+
+def test_import_benchmark():
+    # See also test_lazy_imports (test_basics.py)
+    baseline = import_time('pass')
+    old = import_time('import panflute, panflute.autofilter, yaml, subprocess, shlex')
+    new = import_time('import panflute')
+    report('import panflute', old - baseline, new - baseline)
@@ -0,0 +1,105 @@
+"""
+Test the optional caches of panflute.cache
+"""
+
+import os
+import sys
+
+import panflute as pf
+from panflute import tools
+from panflute.cache import ResultCache, convert_cache, shell_cache
+
+
+def test_result_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('PANFLUTE_CACHE_DIR', str(tmp_path))
+    cache = ResultCache('test', memory_items=2, max_size=1000)
+
+    keys = [cache.key('text', ['--from=markdown'], i) for i in range(3)]
+    assert len(set(keys)) == 3
+    assert cache.key(b'a', 'b') != cache.key(b'ab') == cache.key(b'ab')
+
+    assert cache.get(keys[0]) is None
+    for i, key in enumerate(keys):
+        cache.set(key, str(i).encode())
+    assert list(cache.memory) == keys[1:]  # LRU
+    assert cache.get(keys[2]) == b'2'
+    assert cache.get(keys[0]) == b'0'  # From disk
+    assert cache.stats() == {'memory_hits': 1, 'disk_hits': 1, 'misses': 1}
+
+    # Other processes see the files
+    other = ResultCache('test', max_size=1000)
+    assert other.get(keys[1]) == b'1'
+    assert other.stats()['disk_hits'] == 1
+
+    # The least recently used files are removed when the cache grows too large
+    cache.max_size = 100
+    cache.set(keys[2], b'y' * 20)
+    os.utime(cache._path(keys[1]), (0, 0))
+    os.utime(cache._path(keys[2]), (1, 1))
+    cache.set(keys[0], b'x' * 80)
+    assert not os.path.exists(cache._path(keys[1]))
+    assert not os.path.exists(cache._path(keys[2]))
+    assert os.path.exists(cache._path(keys[0]))
+
+    cache.clear()
+    assert cache.get(keys[0]) is None
+
+
+def test_convert_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('PANFLUTE_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('PANFLUTE_CACHE', '1')
+    monkeypatch.setattr(convert_cache, 'memory', type(convert_cache.memory)())
+    convert_cache.reset_stats()
+
+    md = 'Some *cached* text'
+    expected = pf.convert_text(md)
+    assert convert_cache.stats() == {'memory_hits': 0, 'disk_hits': 0, 'misses': 1}
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Pandoc should not be called')
+
+    monkeypatch.setattr(tools, 'run_pandoc', fail)
+    assert pf.convert_text(md) == expected
+    convert_cache.memory.clear()
+    assert pf.convert_text(md) == expected
+    assert convert_cache.stats() == {'memory_hits': 1, 'disk_hits': 1, 'misses': 1}
+
+    # Disabled by default
+    monkeypatch.delenv('PANFLUTE_CACHE')
+    convert_cache.reset_stats()
+    monkeypatch.undo()
+    assert pf.convert_text(md) == expected
+    assert convert_cache.stats()['misses'] == 0
+
+
+def test_shell_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('PANFLUTE_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(shell_cache, 'memory', type(shell_cache.memory)())
+    shell_cache.reset_stats()
+
+    # Echoes stdin and logs each call
+    log = tmp_path / 'calls.txt'
+    code = ('import sys; open(sys.argv[1], "a").write("x"); '
+            'sys.stdout.write(sys.stdin.read().upper())')
+    args = [sys.executable, '-c', code, str(log)]
+
+    assert pf.shell(args, msg=b'digraph', cache=True) == b'DIGRAPH'
+    assert pf.shell(args, msg=b'digraph', cache=True) == b'DIGRAPH'
+    assert pf.shell(args, msg=b'graph', cache=True) == b'GRAPH'
+    assert log.read_text() == 'xx'
+
+    shell_cache.memory.clear()
+    assert pf.shell(args, msg=b'digraph', cache=True) == b'DIGRAPH'
+    assert pf.shell(args, msg=b'digraph') == b'DIGRAPH'
+    assert log.read_text() == 'xxx'
+    assert shell_cache.stats() == {'memory_hits': 1, 'disk_hits': 1, 'misses': 2}
+
+    # Path arguments, as in Popen
+    from pathlib import Path
+    assert pf.shell([Path(sys.executable)] + args[1:], msg=b'digraph', cache=True) == b'DIGRAPH'
+    assert log.read_text() == 'xxx'
+
+    # $PANFLUTE_CACHE=0 turns off every cache
+    monkeypatch.setenv('PANFLUTE_CACHE', '0')
+    assert pf.shell(args, msg=b'digraph', cache=True) == b'DIGRAPH'
+    assert log.read_text() == 'xxxx'
@@ -133,5 +133,46 @@ ipsum"""
     assert md == md2panflute2md
 
 
+def test_convert_text_many():
+    texts = ['Some *markdown*', '', 'b\n\nc', '- x\n- y', '> quote', '    code', 'x[^1]\n\n[^1]: note']
+    expected = [pf.convert_text(text) for text in texts]
+    assert pf.convert_text_many(texts) == expected
+    assert pf.convert_text_many(texts[:1]) == expected[:1]
+    assert pf.convert_text_many([]) == []
+
+    latex = [r'\emph{a}', 'b']
+    assert pf.convert_text_many(latex, input_format='latex') == [pf.convert_text(text, input_format='latex') for text in latex]
+
+    # An unclosed div swallows the separators, so the texts are converted one by one
+    texts = ['::: foo\na', 'b']
+    assert pf.convert_text_many(texts) == [pf.convert_text(text) for text in texts]
+
+
+def test_pandoc_info_cache(tmp_path, monkeypatch):
+    from panflute import tools
+
+    monkeypatch.setenv('PANFLUTE_CACHE_DIR', str(tmp_path))
+    tools.get_pandoc_info.cache_clear()
+    info = tools.get_pandoc_info()
+    assert info['version'].startswith('pandoc ')
+    assert tuple(info['api_version']) == pf.convert_text('', standalone=True).api_version
+    assert (tmp_path / 'pandoc.json').exists()
+
+    # Later processes read it from disk, without calling Pandoc
+    def fail(*args, **kwargs):
+        raise AssertionError('Pandoc should not be called')
+
+    tools.get_pandoc_info.cache_clear()
+    monkeypatch.setattr(tools, 'run_pandoc', fail)
+    monkeypatch.setattr(tools, 'convert_text', fail)
+    assert tools.get_pandoc_info() == info
+    version = tools.PandocVersion()
+    assert str(version) == info['version'].split()[1]
+    assert version.api_version == tuple(info['api_version'])
+    assert version.data_dir == pf.get_filter_dirs(hardcoded=False)
+    tools.get_pandoc_info.cache_clear()
+
+
 if __name__ == "__main__":
     test_all()
+    test_convert_text_many()
@@ -38,3 +38,259 @@ def test_builtin2meta(value, expect_type):
     but does not work since __eq__ methods are not defined for MetaValue classes.
     """
     assert type(builtin2meta(value)) == expect_type
+
+
+def test_trusted_construction():
+    import gc
+    import panflute as pf
+    from panflute.utils import trusted_construction
+
+    # User-facing constructors are strict
+    with pytest.raises(TypeError):
+        pf.Para(pf.Para())
+    assert pf.Para(pf.Space).content[0] == pf.Space()
+
+    # Trusted trees are built as they are
+    gc_enabled = gc.isenabled()
+    with trusted_construction():
+        assert not gc.isenabled()
+        para = pf.Para(pf.Str('a'), pf.Space())
+        header = pf.Header(level=2, identifier='b', classes=['c'])
+    assert gc.isenabled() == gc_enabled
+    assert para.content[1].parent is para and para.content[1].index == 1
+    assert header.level == 2 and header.classes == ['c']
+
+    with pytest.raises(TypeError):
+        pf.Para(pf.Para())
+
+    # Overlapping uses from several threads resume the collector only
+    # once the last one ends
+    import threading
+    entered, first_done = threading.Barrier(2), threading.Event()
+
+    def first():
+        with trusted_construction():
+            entered.wait()
+        first_done.set()
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    with trusted_construction():
+        entered.wait()
+        first_done.wait()
+        assert not gc.isenabled()
+    thread.join()
+    assert gc.isenabled() == gc_enabled
+
+
+def test_clone():
+    import panflute as pf
+
+    table = pf.Table(pf.TableBody(pf.TableRow(pf.TableCell(pf.Plain(pf.Str('x'))))),
+                     caption=pf.Caption(pf.Plain(pf.Str('Caption'))))
+    doc = pf.Doc(pf.Header(pf.Str('Title'), level=2, classes=['a']),
+                 pf.Para(pf.Emph(pf.Str('b')), pf.Cite(citations=[pf.Citation('c')])),
+                 table, metadata={'title': 'Clone'}, format='latex')
+    doc.counter = 3
+
+    clone = doc.clone()
+    assert clone == doc and clone is not doc
+    assert clone.format == 'latex' and clone.counter == 3
+
+    # Every element is new, and points to its new parent
+    old_ids = {id(elem) for elem in doc.iter_descendants()}
+    assert not old_ids & {id(elem) for elem in clone.iter_descendants()}
+    para = clone.content[1]
+    assert para.parent is clone and para.index == 1
+    assert para.content[0].content[0].parent is para.content[0]
+    assert para.content[1].citations[0].parent is para.content[1]
+    assert clone.content[2].caption.parent is clone.content[2]
+
+    # Changing the clone doesn't change the original
+    header = doc.content[0].clone()
+    assert header.parent is None
+    header.classes.append('b')
+    header.content[0].text = 'Changed'
+    assert doc.content[0].classes == ['a']
+    assert pf.stringify(doc.content[0]) == 'Title'
+
+    # Nor does it share its digest
+    hash(doc.content[0])
+    header = doc.content[0].clone()
+    header.identifier = 'x'
+    header.content[0].text = 'y'
+    assert header != doc.content[0] and hash(header) != hash(doc.content[0])
+
+    # Deep trees don't hit the recursion limit
+    block = pf.Para(pf.Str('bottom'))
+    for _ in range(5000):
+        block = pf.Div(block)
+    assert block.clone().digest() == block.digest()
+
+
+def test_packed_text():
+    import io
+    import panflute as pf
+
+    def make_doc():
+        return pf.Doc(pf.Para(pf.Str('Some'), pf.Space, pf.Str('text'), pf.SoftBreak, pf.Str('here.')),
+                      pf.Para(pf.Str('With'), pf.Space, pf.Emph(pf.Str('emphasis'))),
+                      pf.Header(pf.Str('Title'), identifier='title'))
+
+    with io.StringIO() as f:
+        pf.dump(make_doc(), f)
+        raw = f.getvalue()
+
+    doc = pf.load(io.StringIO(raw), compact=True)
+    assert doc.content[0].content.packed == 'Some text\nhere.'
+    assert doc.content[1].content.packed is None  # Not only text
+    assert doc.content[1].content[2].content.packed == 'emphasis'
+
+    # Nothing is unpacked by dump, ==, clone, or walks that skip text
+    with io.StringIO() as f:
+        pf.dump(doc, f)
+        assert f.getvalue() == raw
+    assert doc.clone() == doc == pf.load(io.StringIO(raw), compact=True)
+    doc.walk({pf.Header: lambda elem, doc: None})
+    assert list(doc.iter_descendants(pf.Emph)) == [doc.content[1].content[2]]
+    assert doc.content[0].content.packed is not None
+
+    # Elements are recreated when accessed
+    para = doc.content[0]
+    assert para.content[3] == pf.SoftBreak()
+    assert para.content.packed is None
+    assert para.content[4].parent is para and para.content[4].index == 4
+    assert doc == make_doc()
+
+    # Only runs of text can be packed, without two Str elements in a row
+    assert not pf.Para(pf.Str('a b')).content.pack()
+    para = pf.Para(pf.Str('a'), pf.Str('b'), pf.Space, pf.Str('c'))
+    assert not para.content.pack()
+    assert para.content != pf.Para(pf.Str('ab'), pf.Space, pf.Str('c')).content
+
+    doc = pf.Doc(para, pf.Header(pf.Str('x'), pf.Str('y'), pf.SoftBreak, pf.Str('z')),
+                 pf.Para(pf.Emph(pf.Str('e')), pf.Str('f'), pf.Str('g')))
+    with io.StringIO() as f:
+        pf.dump(doc, f)
+        raw = f.getvalue()
+    with io.StringIO() as f:
+        pf.dump(pf.load(io.StringIO(raw), compact=True), f)
+        assert f.getvalue() == raw
+    assert not pf.Para(pf.Str('')).content.pack()
+    para = pf.Para(pf.Space, pf.Space, pf.Str('a'))
+    assert para.content.pack()
+    assert list(para.content) == [pf.Space(), pf.Space(), pf.Str('a')]
+
+
+def test_shared_elements():
+    import io
+    import panflute as pf
+    from panflute.containers import SHARED
+
+    doc = pf.Doc(pf.Para(pf.Str('a'), pf.Space, pf.Emph(pf.Str('b')), pf.Space, pf.Str('c')),
+                 pf.HorizontalRule, pf.Para(pf.Str('d'), pf.Space, pf.Code('e')))
+    with io.StringIO() as f:
+        pf.dump(doc, f)
+        raw = f.getvalue()
+
+    doc = pf.load(io.StringIO(raw), compact=True)
+    spaces = doc.content[0].content.list[1::2] + [doc.content[2].content.list[1]]
+    assert all(space is spaces[0] and space.location is SHARED for space in spaces)
+
+    # Walks that don't apply to them keep them shared
+    doc.walk({pf.Emph: lambda elem, doc: None})
+    assert list(doc.iter_descendants(pf.Code)) == [doc.content[2].content[2]]
+    assert doc.content[2].content.list[1] is spaces[0]
+
+    # Otherwise each container gets its own copy, with the right parent
+    seen = []
+    def record(elem, doc):
+        if isinstance(elem, (pf.Space, pf.HorizontalRule)):
+            seen.append(elem)
+            assert elem.parent.content[elem.index] is elem
+    doc.walk(record)
+    assert len({id(elem) for elem in seen}) == len(seen) == 4
+    assert all(elem.location is None for elem in seen)
+
+    space = doc.content[0].content[3]
+    assert space.parent is doc.content[0] and space.index == 3
+    assert space.prev == pf.Emph(pf.Str('b')) and space.next == pf.Str('c')
+    assert doc == pf.load(io.StringIO(raw))
+
+    # Copies keep shared elements shared, and packed text packed
+    import copy
+    import pickle
+    doc = pf.load(io.StringIO(raw), compact=True)
+    doc.content.append(pf.Para(pf.Str('f'), pf.Space, pf.Str('g')))
+    doc.content[-1].content.pack()
+    for other in (copy.deepcopy(doc), pickle.loads(pickle.dumps(doc))):
+        assert other.content[-1].content.packed == 'f g'
+        spaces = other.content[0].content.list[1::2] + [other.content[2].content.list[1]]
+        assert all(space is spaces[0] and space.location is SHARED for space in spaces)
+        space = other.content[2].content[1]
+        assert space.parent is other.content[2] and space.index == 1
+        assert space.prev == pf.Str('d') and space.next == pf.Code('e')
+        assert other == doc
+
+
+def test_container_indexes():
+    import panflute as pf
+
+    para = pf.Para(*[pf.Str(str(i)) for i in range(5)])
+
+    def check():
+        for i, elem in enumerate(para.content.list):
+            assert elem.index == i and elem.parent is para
+
+    # Iteration attaches the elements, as indexing does
+    assert [elem.index for elem in para.content] == list(range(5))
+    assert para.content[-1].index == 4 and para.content[-1].prev.text == '3'
+    for i in (5, -6):
+        with pytest.raises(IndexError):
+            para.content[i]
+
+    # Indexes stay up to date after inserting or deleting elements
+    para.content.insert(0, pf.Str('a'))
+    check()
+    para.content.insert(-2, pf.Str('b'))
+    check()
+    para.content.append(pf.Str('c'))
+    check()
+    del para.content[1]
+    check()
+    del para.content[-3:-1]
+    check()
+    para.content[1:2] = [pf.Str('d'), pf.Str('e')]
+    check()
+    assert pf.stringify(para) == 'ade2bc\n\n'
+
+
+def test_sibling_navigation():
+    import panflute as pf
+
+    para = pf.Para(*[pf.Str(str(i)) for i in range(10)])
+    items = list(para.content)
+
+    # Elements are renumbered only when an index that might have moved is read
+    para.content.insert(2, pf.Str('a'))
+    del para.content[0]
+    assert para.content.stale == 0
+    assert items[9].prev.text == '8' and items[9].next is None  # Didn't move
+    assert para.content.stale == 0
+    assert items[1].index == 0 and items[1].next.text == 'a'
+    assert para.content.stale is None
+    assert [elem.index for elem in items[1:]] == [0] + list(range(2, 10))
+    para.content[4:6] = [pf.Str('b')]
+    assert items[9].index == 8 and items[3].offset(-2).text == 'a'
+
+    # Slices with a negative step
+    para = pf.Para(*[pf.Str(str(i)) for i in range(4)])
+    items = list(para.content)
+    del para.content[::-2]
+    assert [elem.index for elem in items[::2]] == [0, 1]
+    assert items[0].next is items[2] and items[2].prev is items[0]
+    para.content.insert(0, pf.Str('a'))
+    para.content[::-2] = [pf.Str('b'), pf.Str('c')]
+    assert pf.stringify(para) == 'c0b\n\n'
+    assert [elem.index for elem in para.content.list] == [0, 1, 2]
+    assert items[0].index == 1 and items[0].offset(1).text == 'b'
@@ -32,5 +32,59 @@ def test_equality():
     assert doc1.content == doc3.content
 
 
+def test_digest():
+    doc1 = pf.convert_text(text, standalone=True)
+    doc2 = pf.convert_text(text, standalone=True)
+
+    assert doc1.digest() == doc2.digest()
+    assert len(doc1.digest()) == 32
+    assert doc1.content[0].digest() != doc1.content[1].digest()
+    assert doc1.content[0].digest() == doc2.content[0].digest()
+
+    # Attribute order doesn't matter, as for ==
+    assert (pf.Div(attributes={'a': '1', 'b': '2'}).digest()
+            == pf.Div(attributes={'b': '2', 'a': '1'}).digest())
+    assert pf.Str('a').digest() != pf.Code('a').digest()
+
+    # Elements can be used as dict keys
+    counts = {}
+    for elem in list(doc1.content) + list(doc2.content):
+        counts[elem] = counts.get(elem, 0) + 1
+    assert list(counts.values()) == [2, 2]
+
+    # Changes through containers, setters and walks discard the digests
+    before = doc2.digest()
+    doc2.content[1].content.append(pf.Str('!'))
+    assert doc1 != doc2 and doc2.digest() != before
+    del doc2.content[1].content[-1]
+    assert doc1 == doc2 and doc2.digest() == before
+
+    doc2.metadata['author'] = pf.MetaInlines(pf.Str('John'))
+    assert doc1 != doc2
+    doc2.metadata['author'] = pf.MetaInlines(pf.Str('Bob'))
+    assert doc2.digest() == before
+
+    def upper_str(elem, doc):
+        elem.text = elem.text.upper()
+
+    doc2.walk({pf.Str: upper_str})
+    assert doc1 != doc2 and doc2.digest() != before
+
+    # Other in-place changes need reset_digest(), but not ==
+    doc1.digest()
+    doc3 = pf.convert_text(text, standalone=True)
+    hash(doc3)
+    doc1.content[0].content[0].text = 'Changed'
+    assert doc1 != doc3 and doc1.content[0] != doc3.content[0]
+    doc1.content[0].content[0].reset_digest()
+    assert doc1.digest() != doc3.digest()
+
+    a, b = pf.Str('x'), pf.Str('x')
+    hash(a), hash(b)
+    a.text = 'y'
+    assert a != b
+
+
 if __name__ == "__main__":
     test_equality()
+    test_digest()
@@ -19,10 +19,15 @@ Additionally, there are two extra keys:
 import os
 import io
 import sys
+import stat
+import socket
 import subprocess
 from pathlib import Path
 
+import pytest
+
 import panflute as pf
+from panflute.server import SOCKET_ENV_VAR, _get_peer_uid
 
 
 # ---------------------------
@@ -122,6 +127,148 @@ def test_pandoc_call():
     assert stdout == expected_output
 
 
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork() and Unix sockets')
+def test_server(tmp_path):
+    """
+    Run documents through a persistent `panfl --serve` (with a preloaded filter)
+    using the `panfl-client` shim, and through the shim alone (no server)
+    """
+    socket_path = str(tmp_path / 'panflute.sock')
+    env = dict(os.environ, PANFLUTE_SOCKET=socket_path)
+    md_document = """---
+panflute-filters: test_filter
+panflute-path: ./tests/test_panfl/bar
+...
+$1-1$
+"""
+    json_document = pf.convert_text(md_document, 'markdown', 'json', standalone=True)
+    expected_output = '$1+1markdown$'
+    client = [sys.executable, '-c', 'from panflute.server import client; client()', 'markdown']
+
+    def run_client(document=json_document):
+        proc = subprocess.run(client, input=document, stdout=subprocess.PIPE, env=env,
+                              encoding='utf-8', check=True)
+        return pf.convert_text(proc.stdout, 'json', 'markdown')
+
+    # Another project, with a different filter of the same name
+    project = tmp_path / 'project'
+    project.mkdir()
+    (project / 'test_filter.py').write_text(
+        (Path('tests') / 'test_panfl' / 'bar' / 'test_filter.py').read_text().replace("'+'", "'*'"))
+    other_document = pf.convert_text(md_document.replace('./tests/test_panfl/bar', str(project)),
+                                     'markdown', 'json', standalone=True)
+
+    # No server: the shim runs panfl in-process
+    assert run_client() == expected_output
+
+    server = subprocess.Popen([sys.executable, '-c', 'import panflute; panflute.panfl()',
+                               '--serve', '--socket', socket_path,
+                               '-d', './tests/test_panfl/bar', 'test_filter'],
+                              env=env, stderr=subprocess.PIPE)
+    try:
+        server.stderr.readline()  # Wait until it's listening
+        assert os.path.exists(socket_path)
+        for _ in range(3):
+            assert run_client() == expected_output
+
+        # Preloaded filters are not used for documents that need another file
+        assert run_client(other_document) == '$1*1markdown$'
+        assert run_client() == expected_output
+
+        # Errors are reported through the client's stderr and exit status
+        proc = subprocess.run(client, input='not json', stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, env=env, encoding='utf-8')
+        assert proc.returncode != 0
+        assert 'JSONDecodeError' in proc.stderr
+
+        # The socket is private, and both ends are run by the same user
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            assert _get_peer_uid(sock) in (None, os.getuid())
+    finally:
+        server.terminate()
+        server.wait()
+
+    # Sockets in folders that others can access are not used
+    shared = tmp_path / 'shared'
+    shared.mkdir(mode=0o755)
+    shared.chmod(0o755)
+    env[SOCKET_ENV_VAR] = str(shared / 'panflute.sock')
+    proc = subprocess.run([sys.executable, '-c', 'import panflute; panflute.panfl()',
+                           '--serve'], env=env, stderr=subprocess.PIPE, encoding='utf-8')
+    assert proc.returncode != 0 and 'mode 0700' in proc.stderr
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(env[SOCKET_ENV_VAR])
+        sock.listen()
+        proc = subprocess.run(client, input=json_document, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, env=env, encoding='utf-8', check=True)
+    assert 'ignoring filter server' in proc.stderr
+    assert pf.convert_text(proc.stdout, 'json', 'markdown') == expected_output
+
+
+def test_filter_cache(tmp_path, monkeypatch, capsys):
+    """
+    Filter locations are cached on disk, and only reused while the filter file
+    (and the folders searched before it) are unchanged
+    """
+    from panflute.autofilter import resolve_filters
+
+    monkeypatch.setenv('PANFLUTE_CACHE_DIR', str(tmp_path / 'cache'))
+    filter_dir = tmp_path / 'filters'
+    filter_dir.mkdir()
+    filter_path = filter_dir / 'my_filter.py'
+    filter_path.write_text('def main(doc=None):\n    return doc\n')
+    early_dir = tmp_path / 'early'
+    (early_dir / 'pkg').mkdir(parents=True)
+    search_dirs = ['./tests/test_panfl/bar', str(early_dir), str(filter_dir)] + sys.path
+
+    expected = [('my_filter', str(filter_path), 'my_filter', str(filter_dir))]
+    assert resolve_filters(['my_filter'], search_dirs, verbose=True) == expected
+    assert '(cached)' not in capsys.readouterr().err
+    assert (tmp_path / 'cache' / 'filters.json').exists()
+
+    assert resolve_filters(['my_filter'], search_dirs, verbose=True) == expected
+    assert '(cached)' in capsys.readouterr().err
+
+    # Different search dirs use a different cache entry
+    resolve_filters(['my_filter'], search_dirs[1:], verbose=True)
+    assert '(cached)' not in capsys.readouterr().err
+
+    # Modified filters are searched again
+    os.utime(filter_path, ns=(0, 0))
+    assert resolve_filters(['my_filter'], search_dirs, verbose=True) == expected
+    assert '(cached)' not in capsys.readouterr().err
+
+    # So are filters shadowed by a new file in a folder searched before them,
+    # including subfolders of module filters
+    (filter_dir / 'pkg').mkdir()
+    (filter_dir / 'pkg' / 'mod.py').write_text('def main(doc=None):\n    return doc\n')
+    assert resolve_filters(['my_filter', 'pkg.mod'], search_dirs)[1][1] == str(filter_dir / 'pkg' / 'mod.py')
+    (early_dir / 'my_filter.py').write_text('def main(doc=None):\n    return doc\n')
+    (early_dir / 'pkg' / 'mod.py').write_text('def main(doc=None):\n    return doc\n')
+    assert resolve_filters(['my_filter', 'pkg.mod'], search_dirs, verbose=True) == [
+        ('my_filter', str(early_dir / 'my_filter.py'), 'my_filter', str(early_dir)),
+        ('pkg.mod', str(early_dir / 'pkg' / 'mod.py'), 'pkg.mod', str(early_dir))]
+    assert '(cached)' not in capsys.readouterr().err
+    (early_dir / 'my_filter.py').unlink()
+    assert resolve_filters(['my_filter'], search_dirs) == expected
+
+    # The cache can be turned off
+    monkeypatch.setenv('PANFLUTE_CACHE', '0')
+    monkeypatch.setenv('PANFLUTE_CACHE_DIR', str(tmp_path / 'no_cache'))
+    assert resolve_filters(['my_filter'], search_dirs, verbose=True) == expected
+    assert resolve_filters(['my_filter'], search_dirs, verbose=True) == expected
+    assert '(cached)' not in capsys.readouterr().err
+    assert not (tmp_path / 'no_cache').exists()
+    monkeypatch.delenv('PANFLUTE_CACHE')
+
+    # So are missing filters
+    filter_path.unlink()
+    with pytest.raises(Exception, match='filter not found'):
+        resolve_filters(['my_filter'], search_dirs)
+
+
 if __name__ == "__main__":
     test_get_filter_dirs()
     test_metadata()
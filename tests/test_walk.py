@@ -2,6 +2,12 @@
 Test how Element.walk() behaves with different return types of action functions
 """
 
+import sys
+import time
+import threading
+
+import pytest
+
 import panflute as pf
 
 
@@ -110,3 +116,376 @@ def test_block_list():
     in_doc.walk(block_replace_list)
     expected_doc = pf.Doc(pf.Para(pf.Str("a")), pf.Para(pf.Str("b")), api_version=api_version)
     assert compare_docs(in_doc, expected_doc)
+
+
+"""
+Test that fused walks (run_filters with fuse=True) match sequential walks
+"""
+
+
+@pf.applies_to(pf.Str)
+def upper_str(elem, doc):
+    return pf.Str(elem.text.upper())
+
+
+@pf.applies_to(pf.Para)
+def para_to_plain(elem, doc):
+    return pf.Plain(*elem.content)
+
+
+def split_str(elem, doc):
+    if isinstance(elem, pf.Str) and len(elem.text) > 1:
+        return [pf.Str(elem.text[0]), pf.Str(elem.text[1:])]
+
+
+def test_fused_walk():
+    actions = [upper_str, split_str, para_to_plain, remove_elem]
+
+    def make_doc():
+        return pf.Doc(pf.Para(pf.Str("ab"), pf.Space, pf.Emph(pf.Str("c"))),
+                      pf.BlockQuote(pf.Para(pf.Str("de"))),
+                      api_version=api_version)
+
+    for n in range(1, len(actions) + 1):
+        sequential = pf.run_filters(actions[:n], doc=make_doc())
+        fused = pf.run_filters(actions[:n], doc=make_doc(), fuse=True)
+        assert sequential == fused
+
+    # remove_elem deletes the Str elements created by the previous actions
+    assert pf.stringify(fused) == ' '
+
+
+def test_fused_walk_skips_types():
+    seen = []
+
+    @pf.applies_to(pf.Block)
+    def collect_blocks(elem, doc):
+        seen.append(elem.tag)
+
+    doc = pf.Doc(pf.Para(pf.Str("a"), pf.Space), pf.CodeBlock("b"))
+    pf.run_filters([collect_blocks], doc=doc, fuse=True)
+    assert seen == ['Para', 'CodeBlock']
+
+    # Without calling anything on the other elements
+    from panflute.io import _prepare_actions
+    from panflute.base import HandlerTable
+    fused, = _prepare_actions([collect_blocks, upper_str], True, {})
+    assert type(fused) is HandlerTable
+    assert fused[pf.Space] is None and fused[pf.Str] is not None
+    fused, = _prepare_actions([collect_blocks, split_str], True, {})
+    assert type(fused) is not HandlerTable
+
+
+def test_walk_applies_to():
+    # Element.walk also honours applies_to (upper_str would fail on a Para)
+    doc = pf.Doc(pf.Para(pf.Str("a"), pf.Space, pf.Emph(pf.Str("b"))))
+    doc = doc.walk(upper_str)
+    assert pf.stringify(doc) == 'A B\n\n'
+    assert doc.content[0].content.walk(upper_str)[0] == pf.Str('A')
+
+
+"""
+Test dispatching actions on the element type with {class: function} dicts
+"""
+
+
+def test_dispatch_walk():
+    calls = []
+
+    def count_calls(elem, doc):
+        calls.append(elem.tag)
+
+    doc = pf.Doc(pf.Para(pf.Str("a"), pf.Space, pf.Emph(pf.Str("b"))),
+                 pf.CodeBlock("c"), api_version=api_version)
+    doc.walk({pf.Str: inline_replace_elem, pf.Block: count_calls})
+    assert calls == ['Para', 'CodeBlock']
+
+    expected_doc = pf.Doc(pf.Para(pf.Str("b"), pf.Space, pf.Emph(pf.Str("b"))),
+                          pf.CodeBlock("c"), api_version=api_version)
+    assert doc == expected_doc
+
+
+def test_dispatch_run_filters():
+    def add_class(elem, doc, name):
+        elem.classes.append(name)
+
+    for fuse in (False, True):
+        doc = pf.Doc(pf.Para(pf.Code("a")), pf.CodeBlock("b"), pf.Div())
+        doc = pf.run_filters([{pf.Code: add_class, pf.CodeBlock: add_class}],
+                             doc=doc, fuse=fuse, name='seen')
+        assert doc.content[0].content[0].classes == ['seen']
+        assert doc.content[1].classes == ['seen']
+        assert doc.content[2].classes == []
+
+
+def test_walk_in_place():
+    doc = pf.Doc(pf.Para(pf.Str("a")), pf.Div(pf.Para(pf.Space)), metadata={'a': 'b'})
+    content, metadata = doc.content, doc.metadata
+    para_content = doc.content[0].content
+    div_content = doc.content[1].content
+
+    # Walks that don't change anything don't rebuild containers
+    doc.walk(do_nothing)
+    assert doc.content is content
+    assert doc.metadata is metadata
+    assert doc.content[0].content is para_content
+
+    # Only the container where an element was replaced gets rebuilt
+    doc.walk(inline_replace_elem)
+    assert doc.content is content
+    assert doc.content[0].content is not para_content
+    assert doc.content[1].content is div_content
+    assert doc.content[0].content[0].parent is doc.content[0]
+    assert doc.get_metadata('a') == 'b'
+
+
+"""
+Test read-only iteration with iter_descendants()
+"""
+
+
+def test_iter_descendants():
+    doc = pf.Doc(pf.Header(pf.Str("Intro")),
+                 pf.Para(pf.Link(pf.Str("a"), url="a.html"), pf.Space,
+                         pf.Note(pf.Para(pf.Link(url="b.html")))),
+                 metadata={'title': pf.MetaInlines(pf.Str("Title"))})
+    content = doc.content
+
+    # Same (post-)order as walk()
+    walked = []
+    doc.walk(lambda elem, doc: walked.append(elem) and None)
+    assert list(doc.iter_descendants(include_self=True)) == walked
+    assert doc.content is content
+
+    urls = [link.url for link in doc.iter_descendants(pf.Link)]
+    assert urls == ["a.html", "b.html"]
+
+    strs = list(doc.content.iter_descendants(pf.Str))
+    assert [s.text for s in strs] == ["Intro", "a"]
+    assert strs[1].parent.tag == 'Link' and strs[1].index == 0
+
+    no_notes = doc.iter_descendants(pf.Link, stop_if=lambda e: isinstance(e, pf.Note))
+    assert [link.url for link in no_notes] == ["a.html"]
+
+    assert [s.text for s in doc.metadata.content.iter_descendants(pf.Str)] == ["Title"]
+
+
+"""
+Test run_filters with processes=N (actions must be defined at the top level)
+"""
+
+
+def count_paras(elem, doc):
+    if isinstance(elem, pf.Para):
+        doc.num_paras += 1
+
+
+def sum_counts(doc, state):
+    doc.num_paras += state['num_paras']
+
+
+def count_doc_calls(elem, doc):
+    if isinstance(elem, pf.Doc):
+        doc.num_docs += 1
+    elif isinstance(elem, pf.MetaValue):
+        doc.num_meta += 1
+
+
+def sum_doc_calls(doc, state):
+    doc.num_docs += state['num_docs']
+    doc.num_meta += state['num_meta']
+
+
+def test_parallel_run_filters():
+    def make_doc():
+        doc = pf.Doc(*[pf.Para(pf.Str(f"p{i}"), pf.Space, pf.Emph(pf.Str("x")))
+                       if i % 3 else pf.CodeBlock(f"c{i}") for i in range(50)],
+                     metadata={'title': 'Parallel'}, format='latex')
+        doc.num_paras = 0
+        return doc
+
+    actions = [upper_str, split_str, count_paras]
+    expected = pf.run_filters(actions, doc=make_doc())
+
+    for fuse in (False, True):
+        doc = pf.run_filters(actions, doc=make_doc(), fuse=fuse, processes=2, merge=sum_counts)
+        assert doc == expected
+        assert doc.num_paras == expected.num_paras == 33
+        assert doc.format == 'latex'
+        assert doc.content[1].parent is doc
+        assert doc.content[1].content[0].parent is doc.content[1]
+
+    # Without merge, the attributes of doc are left untouched
+    doc = pf.run_filters(actions, doc=make_doc(), processes=2)
+    assert doc == expected and doc.num_paras == 0
+
+    # Empty documents don't start a pool
+    assert pf.run_filters(actions, doc=pf.Doc(), processes=2) == pf.Doc()
+
+    # The metadata and the document itself are filtered once, not once per chunk
+    counts = []
+    for processes in (None, 2):
+        doc = make_doc()
+        doc.num_docs = doc.num_meta = 0
+        doc = pf.run_filters([count_doc_calls, upper_str], doc=doc, processes=processes,
+                             merge=sum_doc_calls)
+        counts.append((doc.num_docs, doc.num_meta))
+    assert counts[0] == counts[1] and counts[0][0] == 1
+
+
+"""
+Test run_filters with incremental=True
+"""
+
+
+def log_para(elem, doc):
+    if isinstance(elem, pf.Para):
+        doc.filtered.append(pf.stringify(elem).strip())
+
+
+@pf.uses_global_state
+def number_para(elem, doc):
+    if isinstance(elem, pf.Para):
+        doc.num_paras += 1
+        elem.content.append(pf.Str(str(doc.num_paras)))
+
+
+def append_para(elem, doc):
+    if isinstance(elem, pf.Doc):
+        elem.content.append(pf.Para(pf.Str('appended')))
+
+
+def log_tag(elem, doc):
+    if isinstance(elem, (pf.Doc, pf.Para, pf.MetaInlines)):
+        doc.filtered.append(elem.tag)
+
+
+def test_incremental_run_filters(tmp_path, monkeypatch):
+    monkeypatch.setenv('PANFLUTE_CACHE_DIR', str(tmp_path))
+
+    def make_doc(*texts):
+        doc = pf.Doc(*[pf.Para(pf.Str(text)) for text in texts],
+                     metadata={'title': pf.MetaInlines(pf.Str('title'))})
+        doc.filtered = []
+        doc.num_paras = 0
+        return doc
+
+    actions = [log_para, upper_str, split_str]
+    for fuse in (False, True):
+        expected = pf.run_filters(actions, doc=make_doc('ab', 'c', 'de'), fuse=fuse)
+        doc = pf.run_filters(actions, doc=make_doc('ab', 'c', 'de'), fuse=fuse, incremental=True)
+        assert doc == expected
+        assert doc.filtered == expected.filtered
+
+        # Only changed blocks are filtered again; the metadata always is
+        expected = pf.run_filters(actions, doc=make_doc('ab', 'xy', 'de'), fuse=fuse)
+        doc = pf.run_filters(actions, doc=make_doc('ab', 'xy', 'de'), fuse=fuse, incremental=True)
+        assert doc == expected
+        assert doc.filtered == expected.filtered[1:2]
+        assert doc.content[2].parent is doc and doc.content[2].index == 2
+        assert pf.stringify(doc.metadata['title']) == 'TITLE'
+
+    # Changing the metadata or the actions invalidates the cache
+    doc = make_doc('ab', 'xy', 'de')
+    doc.metadata['lang'] = 'en'
+    doc = pf.run_filters(actions, doc=doc, incremental=True)
+    assert doc.filtered == ['ab', 'xy', 'de']
+    doc = pf.run_filters(actions[:-1], doc=make_doc('ab', 'xy', 'de'), incremental=True)
+    assert doc.filtered == ['ab', 'xy', 'de']
+
+    # Actions that use global state are always run on the whole document
+    for _ in range(2):
+        doc = pf.run_filters([log_para, number_para], doc=make_doc('a', 'b'), incremental=True)
+        assert doc.filtered == ['a', 'b']
+        assert pf.stringify(doc.content[1]).strip() == 'b2'
+
+    # Same results and order (metadata, blocks, doc) as a regular run, even
+    # if an action applied to the document changes its blocks
+    for actions in ([log_tag, append_para, upper_str], [log_tag, upper_str, append_para]):
+        expected = pf.run_filters(actions, doc=make_doc('a', 'b'))
+        for _ in range(2):
+            doc = pf.run_filters(actions, doc=make_doc('a', 'b'), incremental=True)
+            assert doc == expected
+        # Blocks are only cached if their results are known
+        if actions[-1] is append_para:
+            assert doc.filtered == ['MetaInlines', 'Doc']
+        else:
+            assert doc.filtered == expected.filtered
+
+
+"""
+Test deferred actions (pf.defer)
+"""
+
+
+def slow_upper(elem, doc, delay, wait=None):
+    time.sleep(delay)
+    if wait is not None:
+        wait()
+    if isinstance(elem, pf.CodeBlock):
+        return pf.CodeBlock(elem.text.upper())
+    elif elem.text == 'drop':
+        return []
+    elif elem.text == 'split':
+        return [pf.Str('sp'), pf.Str('lit')]
+    elif elem.text != 'keep':
+        return pf.Str(elem.text.upper())
+
+
+def defer_upper(elem, doc):
+    if isinstance(elem, (pf.CodeBlock, pf.Str)):
+        return pf.defer(slow_upper, elem, doc, delay=0.2)
+
+
+def test_defer():
+    doc = pf.Doc(*[pf.CodeBlock(f"code {i}") for i in range(10)],
+                 pf.Para(pf.Str("a"), pf.Str("keep"), pf.Str("drop"), pf.Str("split")),
+                 pf.Div(pf.Para(pf.Emph(pf.Str("b")))))
+
+    # The deferred calls run concurrently: the first two wait for each other
+    # (if they didn't overlap, the barrier would time out and the walk fail)
+    barrier = threading.Barrier(2, timeout=30)
+
+    def action(elem, doc):
+        if isinstance(elem, (pf.CodeBlock, pf.Str)):
+            wait = barrier.wait if elem.text in ('code 0', 'code 1') else None
+            return pf.defer(slow_upper, elem, doc, delay=0, wait=wait)
+
+    doc = doc.walk(action)
+    assert barrier.n_waiting == 0 and not barrier.broken
+
+    assert [block.text for block in doc.content[:10]] == [f"CODE {i}" for i in range(10)]
+    assert [s.text for s in doc.content[10].content] == ["A", "keep", "sp", "lit"]
+    assert doc.content[11].content[0].content[0].content[0].text == "B"
+    assert doc.content[10].content[3].parent is doc.content[10]
+    assert doc.content[10].content[3].index == 3
+    assert not any(isinstance(e, pf.Deferred) for e in doc.iter_descendants())
+
+    # The root of the walk, and list containers
+    assert pf.Str("x").walk(defer_upper) == pf.Str("X")
+    ans = doc.content[10].content.walk(defer_upper)
+    assert [s.text for s in ans] == ["A", "keep", "SP", "LIT"]
+
+    # Errors are raised at the end of the walk
+    with pytest.raises(AttributeError):
+        pf.Para(pf.Space).walk(lambda elem, doc: pf.defer(slow_upper, elem, doc, delay=0))
+
+    with pytest.raises(RuntimeError):
+        pf.defer(slow_upper, pf.Str("a"), None, delay=0)
+
+
+def test_walk_deep_doc():
+    # Deeper than the recursion limit, so walks must not be recursive
+    depth = 2 * sys.getrecursionlimit()
+    block = pf.Para(pf.Str('bottom'))
+    for i in range(depth):
+        block = pf.BlockQuote(block) if i % 2 else pf.Div(block)
+
+    def upper_str(elem, doc):
+        if isinstance(elem, pf.Str):
+            return pf.Str(elem.text.upper())
+
+    elem = pf.Doc(block).walk(upper_str).content[0]
+    for _ in range(depth):
+        elem = elem.content[0]
+    assert elem == pf.Para(pf.Str('BOTTOM'))